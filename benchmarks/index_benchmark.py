@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""Benchmark the Submission and Result indexes on a synthetic dataset.
+
+This builds a SQLite database with the same tables and columns that Django
+creates for Submission and Result, fills it with several years of synthetic
+coursework, and times the hot queries with only the foreign key indexes that
+Django creates by default, and then with the indexes declared in models.py.
+It does not need Django, so it can be run anywhere:
+
+    python3 benchmarks/index_benchmark.py --years 6
+"""
+
+from argparse import ArgumentParser
+from os import unlink
+from os.path import exists
+from random import Random
+from statistics import median
+from tempfile import mkstemp
+from time import perf_counter
+import sqlite3
+
+SCHEMA = [
+    '''
+    CREATE TABLE demograder_submission (
+        id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+        timestamp datetime NOT NULL,
+        project_id integer NOT NULL,
+        student_id integer NOT NULL,
+        num_passed integer NOT NULL,
+        num_failed integer NOT NULL,
+        num_tbd integer NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE demograder_result (
+        id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+        timestamp datetime NOT NULL,
+        stdout text NOT NULL,
+        stderr text NOT NULL,
+        return_code integer NULL,
+        cache_hit bool NOT NULL,
+        submission_id integer NOT NULL
+    )
+    ''',
+    # the foreign key indexes that Django creates anyway
+    'CREATE INDEX demograder_submission_project_id ON demograder_submission (project_id)',
+    'CREATE INDEX demograder_submission_student_id ON demograder_submission (student_id)',
+    'CREATE INDEX demograder_result_submission_id ON demograder_result (submission_id)',
+]
+
+# the indexes in the Meta of Submission and Result
+INDEXES = [
+    'CREATE INDEX submission_student_project ON demograder_submission (student_id, project_id, timestamp DESC)',
+    'CREATE INDEX submission_project_timestamp ON demograder_submission (project_id, timestamp DESC)',
+    'CREATE INDEX result_submission_return_code ON demograder_result (submission_id, return_code)',
+    'CREATE INDEX result_tbd ON demograder_result (id) WHERE return_code IS NULL',
+]
+
+# (name, SQL, function from the dataset to parameters)
+QUERIES = [
+    (
+        'submissions of a student to a project',
+        '''
+        SELECT id FROM demograder_submission
+        WHERE student_id = ? AND project_id = ?
+        ORDER BY timestamp DESC
+        ''',
+        lambda dataset, rng: rng.choice(dataset['student_projects']),
+    ),
+    (
+        'latest submissions to a project',
+        '''
+        SELECT id FROM demograder_submission
+        WHERE project_id = ?
+        ORDER BY timestamp DESC LIMIT 100
+        ''',
+        lambda dataset, rng: (rng.randrange(dataset['num_projects']) + 1,),
+    ),
+    (
+        'passed Results of a submission',
+        '''
+        SELECT COUNT(*) FROM demograder_result
+        WHERE submission_id = ? AND return_code = 0
+        ''',
+        lambda dataset, rng: (rng.randrange(dataset['num_submissions']) + 1,),
+    ),
+    (
+        'TBD Results (instructor_tbd_view)',
+        '''
+        SELECT id, submission_id FROM demograder_result
+        WHERE return_code IS NULL
+        ORDER BY id LIMIT 200
+        ''',
+        lambda dataset, rng: (),
+    ),
+    (
+        'number of TBD Results (dispatch_tbd)',
+        '''
+        SELECT COUNT(*) FROM demograder_result
+        WHERE return_code IS NULL
+        ''',
+        lambda dataset, rng: (),
+    ),
+]
+
+
+def generate(connection, args):
+    """Fill the database with synthetic submissions and results.
+
+    Returns:
+        dict: facts about the dataset that the queries are parameterized by
+    """
+    rng = Random(args.seed)
+    num_semesters = 2 * args.years
+    num_projects = 0
+    num_submissions = 0
+    num_results = 0
+    student_projects = []
+    submissions = []
+    results = []
+    stdout = 'FUNCTION CALL\n-------------\nfoo(1, 2)\n\nEXPECTED RETURN VALUE\n---------------------\n3\n'
+    for semester in range(num_semesters):
+        for course in range(args.courses):
+            students = range(
+                (semester * args.courses + course) * args.students + 1,
+                (semester * args.courses + course + 1) * args.students + 1,
+            )
+            projects = range(num_projects + 1, num_projects + args.projects + 1)
+            num_projects += args.projects
+            for student in students:
+                for project in projects:
+                    student_projects.append((student, project))
+                    for index in range(rng.randint(1, 2 * args.submissions - 1)):
+                        num_submissions += 1
+                        timestamp = '{:04d}-{:02d}-{:02d} {:02d}:00:00'.format(
+                            2000 + semester // 2, 1 + 6 * (semester % 2) + index % 6, 1 + project % 28, index % 24,
+                        )
+                        submissions.append((num_submissions, timestamp, project, student, 0, 0, 0))
+                        for _ in range(args.results):
+                            num_results += 1
+                            if rng.random() < args.tbd_rate:
+                                return_code = None
+                            else:
+                                return_code = rng.choice((0, 0, 0, 1))
+                            results.append((num_results, timestamp, stdout, '', return_code, False, num_submissions))
+            connection.executemany('INSERT INTO demograder_submission VALUES (?, ?, ?, ?, ?, ?, ?)', submissions)
+            connection.executemany('INSERT INTO demograder_result VALUES (?, ?, ?, ?, ?, ?, ?)', results)
+            submissions = []
+            results = []
+    connection.commit()
+    return {
+        'num_projects': num_projects,
+        'num_submissions': num_submissions,
+        'num_results': num_results,
+        'student_projects': student_projects,
+    }
+
+
+def get_plan(connection, sql, parameters):
+    rows = connection.execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+    return '; '.join(row[-1] for row in rows)
+
+
+def time_queries(connection, dataset, args):
+    timings = []
+    for name, sql, get_parameters in QUERIES:
+        rng = Random(args.seed)
+        plan = get_plan(connection, sql, get_parameters(dataset, rng))
+        durations = []
+        for _ in range(args.repeat):
+            parameters = get_parameters(dataset, rng)
+            start = perf_counter()
+            connection.execute(sql, parameters).fetchall()
+            durations.append(perf_counter() - start)
+        timings.append((name, plan, median(durations)))
+    return timings
+
+
+def main():
+    arg_parser = ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--years', type=int, default=6, help='number of academic years (two semesters each)')
+    arg_parser.add_argument('--courses', type=int, default=3, help='number of courses per semester')
+    arg_parser.add_argument('--students', type=int, default=35, help='number of students per course')
+    arg_parser.add_argument('--projects', type=int, default=12, help='number of projects per course')
+    arg_parser.add_argument('--submissions', type=int, default=4, help='mean number of submissions per project')
+    arg_parser.add_argument('--results', type=int, default=6, help='number of Results per submission')
+    arg_parser.add_argument('--tbd-rate', type=float, default=0.001, help='fraction of Results that are TBD')
+    arg_parser.add_argument('--repeat', type=int, default=50, help='number of times to run each query')
+    arg_parser.add_argument('--seed', type=int, default=8675309, help='random seed')
+    arg_parser.add_argument('--database', help='path of the database to create (default: a temporary file)')
+    args = arg_parser.parse_args()
+    path = args.database
+    if path is None:
+        _, path = mkstemp(suffix='.sqlite3')
+        unlink(path)
+    elif exists(path):
+        arg_parser.error('{} already exists'.format(path))
+    connection = sqlite3.connect(path)
+    try:
+        for statement in SCHEMA:
+            connection.execute(statement)
+        start = perf_counter()
+        dataset = generate(connection, args)
+        print('Generated {} submissions and {} results in {:.1f} seconds.'.format(
+            dataset['num_submissions'], dataset['num_results'], perf_counter() - start,
+        ))
+        connection.execute('ANALYZE')
+        before = time_queries(connection, dataset, args)
+        for statement in INDEXES:
+            connection.execute(statement)
+        connection.execute('ANALYZE')
+        after = time_queries(connection, dataset, args)
+        for (name, plan_before, time_before), (_, plan_after, time_after) in zip(before, after):
+            print()
+            print(name)
+            print('    before: {:9.3f} ms  {}'.format(1000 * time_before, plan_before))
+            print('    after:  {:9.3f} ms  {}'.format(1000 * time_after, plan_after))
+    finally:
+        connection.close()
+        if args.database is None:
+            unlink(path)
+
+
+if __name__ == '__main__':
+    main()
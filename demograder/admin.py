@@ -7,7 +7,7 @@ from .models import Department, Course
 from .models import Person
 from .models import Enrollment
 from .models import Assignment, Project, ProjectFile
-from .models import Submission, Upload, Result
+from .models import Submission, LatestSubmission, Upload, Result, CachedEvaluation
 from .models import ProjectDependency, StudentDependency, ResultDependency
 
 
@@ -32,7 +32,10 @@ class AssignmentAdmin(admin.ModelAdmin):
 
 
 class ProjectAdmin(admin.ModelAdmin):
-    list_display = ('id', 'assignment', 'name', 'visible', 'locked')
+    list_display = (
+        'id', 'assignment', 'name', 'visible', 'locked', 'cache_results', 'memory_limit', 'cpu_limit', 'pids_limit',
+        'submission_interval', 'submission_burst',
+    )
 
 
 class ProjectFileAdmin(admin.ModelAdmin):
@@ -43,12 +46,20 @@ class SubmissionAdmin(admin.ModelAdmin):
     list_display = ('id', 'project', 'student', 'iso_format', 'uploads_str')
 
 
+class LatestSubmissionAdmin(admin.ModelAdmin):
+    list_display = ('id', 'project', 'student', 'submission')
+
+
 class UploadAdmin(admin.ModelAdmin):
     list_display = ('id', 'iso_format', 'project', 'student', 'filename')
 
 
 class ResultAdmin(admin.ModelAdmin):
-    list_display = ('id', 'submission_iso_format', 'project', 'student', 'return_code')
+    list_display = ('id', 'submission_iso_format', 'project', 'student', 'return_code', 'timed_out', 'cache_hit', 'wall_time', 'max_rss')
+
+
+class CachedEvaluationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'digest', 'timestamp', 'return_code')
 
 
 class ProjectDependencyAdmin(admin.ModelAdmin):
@@ -72,8 +83,10 @@ admin.site.register(Assignment, AssignmentAdmin)
 admin.site.register(Project, ProjectAdmin)
 admin.site.register(ProjectFile, ProjectFileAdmin)
 admin.site.register(Submission, SubmissionAdmin)
+admin.site.register(LatestSubmission, LatestSubmissionAdmin)
 admin.site.register(Upload, UploadAdmin)
 admin.site.register(Result, ResultAdmin)
+admin.site.register(CachedEvaluation, CachedEvaluationAdmin)
 admin.site.register(ProjectDependency, ProjectDependencyAdmin)
 admin.site.register(StudentDependency, StudentDependencyAdmin)
 admin.site.register(ResultDependency, ResultDependencyAdmin)
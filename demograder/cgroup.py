@@ -0,0 +1,93 @@
+from collections import namedtuple
+from os import mkdir, rmdir
+from os.path import exists, join as join_path
+from time import sleep
+
+# this module is used from the sandbox threads, so it must not depend on Django
+
+# memory is in MiB, cpu is in number of CPUs; None is unlimited
+Limits = namedtuple('Limits', ('memory', 'cpu', 'pids'))
+
+CPU_PERIOD = 100000
+
+# moves the shell into the cgroup (whose cgroup.procs is $0), then runs the
+# command, so that everything it starts is in the cgroup from the beginning
+WRAPPER_SCRIPT = 'echo $$ > "$0" && exec "$@"'
+
+
+def _write(cgroup, filename, value):
+    with open(join_path(cgroup, filename), 'w') as fd:
+        fd.write(str(value))
+
+
+def create_cgroup(path, limits):
+    """Create a cgroup (v2) with some limits.
+
+    The parent directory must be a cgroup delegated to the current user, with
+    the memory, cpu, and pids controllers enabled for its children.
+
+    Parameters:
+        path (str): the path of the new cgroup
+        limits (Limits): the limits of the cgroup
+
+    Returns:
+        str: the path of the cgroup
+    """
+    mkdir(path)
+    if limits.memory is not None:
+        _write(path, 'memory.max', limits.memory * 2**20)
+        if exists(join_path(path, 'memory.swap.max')):
+            _write(path, 'memory.swap.max', 0)
+    if limits.cpu is not None:
+        _write(path, 'cpu.max', '{} {}'.format(max(1000, int(limits.cpu * CPU_PERIOD)), CPU_PERIOD))
+    if limits.pids is not None:
+        _write(path, 'pids.max', limits.pids)
+    return path
+
+
+def wrap_command(cgroup, cmd):
+    return ['sh', '-c', WRAPPER_SCRIPT, join_path(cgroup, 'cgroup.procs')] + cmd
+
+
+def _read_events(cgroup, filename):
+    events = {}
+    try:
+        with open(join_path(cgroup, filename)) as fd:
+            for line in fd:
+                key, value = line.split()
+                events[key] = int(value)
+    except FileNotFoundError:
+        pass
+    return events
+
+
+def get_violations(cgroup):
+    """Find the limits that the processes of a cgroup ran into.
+
+    Returns:
+        [str]: the names of the exceeded limits ("memory" or "pids")
+    """
+    violations = []
+    if _read_events(cgroup, 'memory.events').get('oom_kill', 0) > 0:
+        violations.append('memory')
+    if _read_events(cgroup, 'pids.events').get('max', 0) > 0:
+        violations.append('pids')
+    return violations
+
+
+def remove_cgroup(cgroup, attempts=10):
+    """Kill any processes left in a cgroup and remove it."""
+    try:
+        # not available before Linux 5.14
+        _write(cgroup, 'cgroup.kill', 1)
+    except OSError:
+        pass
+    for _ in range(attempts):
+        try:
+            rmdir(cgroup)
+            return
+        except FileNotFoundError:
+            return
+        except OSError:
+            # the killed processes have not exited yet
+            sleep(0.1)
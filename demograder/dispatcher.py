@@ -1,14 +1,22 @@
+import json
 import sys
-from collections import defaultdict
-from itertools import product
-from os import chdir, chmod, environ, getcwd, walk
-from os.path import basename, dirname, join as join_path, realpath
-from shutil import copyfile
+from collections import defaultdict, namedtuple
+from hashlib import sha256
+from itertools import groupby, islice, product
+from os import chmod, environ, makedirs, scandir, unlink
+from os.path import basename, dirname, exists, join as join_path, realpath, samefile
+from random import random
+from shutil import rmtree
+from socket import timeout as SocketTimeout
 from sqlite3 import OperationalError as SQLiteOperationalError
-from subprocess import run as run_process, PIPE
+from subprocess import Popen, DEVNULL, PIPE
 from tempfile import TemporaryDirectory
+from time import monotonic, sleep
 
 import django
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
 from django.db.utils import OperationalError as DjangoOperationalError
 
 sys.path.append(join_path(dirname(realpath(__file__)), '..'))
@@ -16,94 +24,550 @@ environ.setdefault('DJANGO_SETTINGS_MODULE', 'demograder.settings')
 django.setup()
 
 import django_rq
-
-from demograder.models import Assignment, Project, ProjectDependency, Submission, Result, ResultDependency
+from redis.exceptions import RedisError
+from rq import get_current_job
+
+from demograder.models import Assignment, Project, ProjectDependency, Submission, Result, ResultDependency, CachedEvaluation
+from demograder.events import publish_evaluations
+from demograder.cgroup import Limits, create_cgroup, get_violations, remove_cgroup, wrap_command
+from demograder.filestore import SANDBOX_PATH, file_digest, link_file, store_contents, store_upload
+from demograder.process import OUTPUT_LIMIT_RETURN_CODE, Usage, collect_output, wait_process
+from demograder.scheduler import INTERACTIVE, REGRADE, RECOVERY, PRIORITIES
+from demograder.scheduler import cancel_evaluations, claim, clear, enqueue_once, get_connection, group_by_flow, pump, record_throughput, release, schedule
+from demograder.scheduler import advance_generation, is_superseded
+from demograder.zygote import request_evaluation
 
 DGLIB = join_path(dirname(realpath(__file__)), 'dglib.py')
-
-
-def recursive_chmod(path):
-    chmod(path, 0o777)
-    for root, dirs, files in walk(path):
-        for d in dirs:
-            chmod(join_path(root, d), 0o777)
-        for f in files:
-            chmod(join_path(root, f), 0o777)
-
-
-def prepare_files(result, temp_dir, timeout):
-    # copy dglib library
-    copyfile(DGLIB, join_path(temp_dir, basename(DGLIB)))
+DGLIB_DIGEST = file_digest(DGLIB)
+
+# TODO 200 was arbitrarily chosen; in the future this should be a project property
+MAX_RESULTS = 200
+DISPATCH_CHUNK_SIZE = 50
+
+RESULT_SINK_KEY = 'demograder:results'
+# results that the sink could not save, kept for inspection
+RESULT_SINK_DEAD_KEY = 'demograder:results:dead'
+
+Evaluation = namedtuple(
+    'Evaluation',
+    ('result', 'stdout', 'stderr', 'return_code', 'cache_hit', 'input_digest', 'usage', 'output_sizes', 'timed_out'),
+)
+SandboxRun = namedtuple('SandboxRun', ('result', 'input_digest', 'dependency_files'))
+SandboxPlan = namedtuple('SandboxPlan', ('timeout', 'limits', 'script', 'shared_files', 'runs'))
+
+
+def get_shared_files(submission):
+    """Get the files that all Results of a submission need in the sandbox.
+
+    Parameters:
+        submission (Submission): the submission being evaluated
+
+    Returns:
+        str: the filename of the grading script
+        dict: from filenames in the sandbox to the stored files to link
+    """
+    shared_files = {}
+    # link dglib library
+    with open(DGLIB, 'rb') as fd:
+        shared_files[basename(DGLIB)] = store_contents(fd.read())
     # copy the submission script manually, to avoid line ending issues
-    tmp_script = join_path(temp_dir, basename(result.project.script.name))
-    with open(result.project.script.name) as in_fd:
-        with open(tmp_script, 'w') as out_fd:
-            for line in in_fd:
-                out_fd.write(line)
-    # copy the submission
-    for upload in result.submission.uploads():
-        copyfile(upload.file.name, join_path(temp_dir, upload.project_file.filename))
-    # copy all dependency files
-    for result_dependency in ResultDependency.objects.filter(result=result):
-        keyword = result_dependency.project_dependency.keyword
-        for upstream_upload in result_dependency.producer.uploads():
-            filepath = upstream_upload.file.name
-            copyfile(filepath, join_path(temp_dir, upstream_upload.project_file.filename))
-    recursive_chmod(temp_dir)
-    return ['sudo', '-u', 'nobody', 'timeout', '-s', 'KILL', str(timeout), tmp_script]
-
-
-def evaluate_submission(result_id):
+    script = basename(submission.project.script.name)
+    with open(submission.project.script.name) as fd:
+        shared_files[script] = store_contents(fd.read().encode('utf-8'))
+    # link the submission
+    for upload in submission.uploads():
+        shared_files[upload.project_file.filename] = upload.file.name
+    return script, shared_files
+
+
+def get_dependency_uploads(result):
+    uploads = []
+    for result_dependency in ResultDependency.objects.filter(result=result).order_by('id'):
+        uploads.extend(result_dependency.producer.uploads())
+    return uploads
+
+
+def get_input_digest(script, timeout, limits, uploads):
+    """Calculate a digest of everything that can affect an evaluation.
+
+    Uploads should be in the same order as they are linked into the sandbox,
+    so that a dependency file that replaces a submission file of the same name
+    is accounted for correctly.
+
+    Parameters:
+        script (str): the path of the stored grading script
+        timeout (int): the timeout of the evaluation
+        limits (Limits): the resource limits that are enforced on the evaluation
+        uploads ([Upload]): the uploads linked into the sandbox
+
+    Returns:
+        str: a SHA-256 hex digest
+    """
+    files = {}
+    for upload in uploads:
+        if not upload.digest:
+            store_upload(upload)
+        files[upload.project_file.filename] = upload.digest
+    digest = sha256()
+    digest.update(DGLIB_DIGEST.encode('utf-8'))
+    digest.update(file_digest(script).encode('utf-8'))
+    digest.update(str(timeout).encode('utf-8'))
+    digest.update(str(tuple(limits)).encode('utf-8'))
+    for filename, file_hash in sorted(files.items()):
+        digest.update('\0{}\0{}'.format(filename, file_hash).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def plan_evaluations(result_ids, use_cache=True):
+    """Work out what needs to be run to evaluate some Results.
+
+    This is the only part of an evaluation that reads from the database.
+    Results whose inputs have been evaluated before are taken from the cache;
+    the rest are grouped into one sandbox per submission.
+
+    Parameters:
+        result_ids ([int]): the IDs of the Results to evaluate
+        use_cache (bool): whether to take Results from the cache; if not, they
+            are all run, and their output replaces what was cached
+
+    Returns:
+        [Evaluation]: the Results that were found in the cache
+        [SandboxPlan]: the Results that need to be run
+    """
+    results = Result.objects.filter(pk__in=result_ids).select_related('submission__project').order_by('submission', 'id')
+    evaluations = []
+    plans = []
+    for _, submission_results in groupby(results, key=(lambda result: result.submission_id)):
+        submission_results = list(submission_results)
+        submission = submission_results[0].submission
+        project = submission.project
+        limits = Limits(project.memory_limit, project.cpu_limit, project.pids_limit)
+        # the limits only affect the output if they are enforced
+        enforced_limits = limits if settings.CGROUP_ROOT else Limits(None, None, None)
+        script, shared_files = get_shared_files(submission)
+        submission_uploads = list(submission.uploads())
+        runs = []
+        for result in submission_results:
+            dependency_uploads = get_dependency_uploads(result)
+            input_digest = None
+            if project.cache_results:
+                input_digest = get_input_digest(
+                    shared_files[script], project.timeout, enforced_limits, submission_uploads + dependency_uploads,
+                )
+            if input_digest and use_cache:
+                cached = CachedEvaluation.objects.filter(digest=input_digest).first()
+                if cached:
+                    evaluations.append(Evaluation(
+                        result, cached.stdout, cached.stderr, cached.return_code, True, None, None, None, False,
+                    ))
+                    continue
+            dependency_files = [(upload.project_file.filename, upload.file.name) for upload in dependency_uploads]
+            runs.append(SandboxRun(result, input_digest, dependency_files))
+        if runs:
+            plans.append(SandboxPlan(project.timeout, limits, script, shared_files, runs))
+    return evaluations, plans
+
+
+def reset_sandbox(temp_dir, shared_files):
+    """Remove everything from a sandbox except the shared files.
+
+    Shared files that were deleted or replaced (eg. by a dependency file of
+    the same name) are linked again.
+
+    Parameters:
+        temp_dir (str): the sandbox directory
+        shared_files (dict): from paths in the sandbox to the stored files
+    """
+    for entry in scandir(temp_dir):
+        if entry.path in shared_files:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            rmtree(entry.path, ignore_errors=True)
+        else:
+            unlink(entry.path)
+    for path, source in shared_files.items():
+        if not exists(path) or not samefile(path, source):
+            link_file(source, path)
+
+
+def is_python_script(path):
+    with open(path, 'rb') as fd:
+        first_line = fd.readline()
+    return first_line.startswith(b'#!') and b'python' in first_line
+
+
+def run_evaluation(cmd, temp_dir):
+    """Run a grading script in a new process.
+
+    Returns:
+        bytes: the (bounded) standard output
+        bytes: the (bounded) standard error
+        (int, int): the sizes of the standard output and error in bytes
+        int: the return code
+        Usage: the resources used by the process tree
+        bool: whether the process was stopped for printing too much
+    """
+    start_time = monotonic()
+    process = Popen(cmd, cwd=temp_dir, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+    stdout_fd = process.stdout.fileno()
+    stderr_fd = process.stderr.fileno()
+    output, _, exceeded = collect_output(
+        [stdout_fd, stderr_fd],
+        head_size=settings.OUTPUT_HEAD_SIZE,
+        tail_size=settings.OUTPUT_TAIL_SIZE,
+        max_size=settings.OUTPUT_MAX_SIZE,
+    )
+    # the script runs as another user, so it cannot be killed directly; once
+    # the pipes are closed, it fails on its next write instead
+    process.stdout.close()
+    process.stderr.close()
+    # the process is reaped with wait4 instead of by Popen, to get its rusage
+    process.returncode, usage = wait_process(process.pid, start_time)
+    return_code = process.returncode
+    if exceeded:
+        return_code = OUTPUT_LIMIT_RETURN_CODE
+    output_sizes = (output[stdout_fd].size, output[stderr_fd].size)
+    return output[stdout_fd].getvalue(), output[stderr_fd].getvalue(), output_sizes, return_code, usage, exceeded
+
+
+def run_zygote_evaluation(script, temp_dir, timeout, cpus=None):
+    return request_evaluation(
+        settings.ZYGOTE_SOCKET,
+        temp_dir,
+        script,
+        timeout,
+        cpus=cpus,
+        head_size=settings.OUTPUT_HEAD_SIZE,
+        tail_size=settings.OUTPUT_TAIL_SIZE,
+        max_size=settings.OUTPUT_MAX_SIZE,
+    )
+
+
+def describe_violations(violations, limits):
+    messages = []
+    if 'memory' in violations:
+        messages.append('The program exceeded the memory limit of {} MiB and was terminated.'.format(limits.memory))
+    if 'pids' in violations:
+        messages.append('The program tried to run more than {} processes or threads at once.'.format(limits.pids))
+    return '\n'.join(messages)
+
+
+def format_output(stdout, stderr, timeout, timed_out=False, exceeded=False, violations=(), limits=None):
+    """Decode the output of a run, and explain why it was stopped, if it was.
+
+    Parameters:
+        stdout (bytes): the (bounded) standard output
+        stderr (bytes): the (bounded) standard error
+        timeout (int): the timeout of the run
+        timed_out (bool): whether the run was killed for exceeding the timeout
+        exceeded (bool): whether the run was stopped for printing too much;
+            its return code is the same as for a program that died of SIGPIPE
+        violations ([str]): the cgroup limits that the run ran into
+        limits (Limits): the resource limits of the run
+
+    Returns:
+        str: the standard output
+        str: the standard error, with the explanations
+    """
+    # the output may have been cut in the middle of a character
+    stdout = stdout.decode('utf-8', errors='replace')
+    stderr = stderr.decode('utf-8', errors='replace')
+    if timed_out:
+        stderr += '\n\n'
+        stderr += 'The program failed to complete within {} seconds and was terminated.'.format(timeout)
+    elif exceeded:
+        stderr += '\n\n'
+        stderr += 'The program printed more than {} bytes and was terminated.'.format(settings.OUTPUT_MAX_SIZE)
+    if violations:
+        stderr += '\n\n' + describe_violations(violations, limits)
+    return stdout.strip(), stderr.strip()
+
+
+def run_sandbox(plan, cpus=None):
+    """Run the Results of a plan one after another in a single sandbox.
+
+    The shared files are linked into the sandbox once; only the dependency
+    files are swapped between runs. If CGROUP_ROOT is set and the project has
+    resource limits, each run gets its own cgroup. This does not touch the
+    database or any process-global state, so it is safe to call from multiple
+    threads.
+
+    Parameters:
+        plan (SandboxPlan): the Results to run and the files they need
+        cpus (str): if given, the CPUs to pin the processes to, in the format
+            accepted by `taskset -c`
+
+    Returns:
+        [Evaluation]: the output of each Result
+    """
+    evaluations = []
+    use_cgroup = bool(settings.CGROUP_ROOT) and any(limit is not None for limit in plan.limits)
+    # Python grading scripts can be forked from a warm interpreter instead,
+    # but the zygote cannot place them in a cgroup
+    use_zygote = (
+        bool(settings.ZYGOTE_SOCKET)
+        and not use_cgroup
+        and is_python_script(plan.shared_files[plan.script])
+    )
+    # create temporary directory
+    makedirs(SANDBOX_PATH, exist_ok=True)
+    with TemporaryDirectory(dir=realpath(SANDBOX_PATH)) as temp_dir:
+        shared_files = {join_path(temp_dir, filename): source for filename, source in plan.shared_files.items()}
+        for path, source in shared_files.items():
+            link_file(source, path)
+        # the linked files are read-only, but the program may create new files
+        chmod(temp_dir, 0o777)
+        cmd = ['sudo', '-u', 'nobody', 'timeout', '-s', 'KILL', str(plan.timeout), join_path(temp_dir, plan.script)]
+        if cpus is not None:
+            cmd = ['taskset', '-c', cpus] + cmd
+        for index, run in enumerate(plan.runs):
+            if index > 0:
+                reset_sandbox(temp_dir, shared_files)
+            # link all dependency files
+            for filename, source in run.dependency_files:
+                link_file(source, join_path(temp_dir, filename))
+            violations = []
+            if use_zygote:
+                try:
+                    stdout, stderr, output_sizes, return_code, usage, exceeded = run_zygote_evaluation(
+                        join_path(temp_dir, plan.script), temp_dir, plan.timeout, cpus=cpus,
+                    )
+                except SocketTimeout:
+                    # the script was started, so it must not be run again
+                    stdout, stderr, output_sizes, return_code, usage, exceeded = b'', b'', None, -9, None, False
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # the zygote is not running; start the script directly
+                    use_zygote = False
+            if use_cgroup:
+                cgroup = create_cgroup(
+                    join_path(settings.CGROUP_ROOT, '{}-{}'.format(basename(temp_dir), index)),
+                    plan.limits,
+                )
+                try:
+                    stdout, stderr, output_sizes, return_code, usage, exceeded = run_evaluation(
+                        wrap_command(cgroup, cmd), temp_dir,
+                    )
+                    violations = get_violations(cgroup)
+                finally:
+                    remove_cgroup(cgroup)
+            elif not use_zygote:
+                stdout, stderr, output_sizes, return_code, usage, exceeded = run_evaluation(cmd, temp_dir)
+            # the memory limit also kills with SIGKILL, like the timeout
+            timed_out = return_code == -9 and 'memory' not in violations
+            stdout, stderr = format_output(
+                stdout, stderr, plan.timeout,
+                timed_out=timed_out, exceeded=exceeded, violations=violations, limits=plan.limits,
+            )
+            evaluations.append(Evaluation(
+                run.result, stdout, stderr, return_code, False, run.input_digest, usage, output_sizes, timed_out,
+            ))
+    return evaluations
+
+
+def save_evaluations(evaluations):
+    # update Results and Submission counts
+    with transaction.atomic():
+        for evaluation in evaluations:
+            evaluation.result.record(
+                evaluation.stdout,
+                evaluation.stderr,
+                evaluation.return_code,
+                cache_hit=evaluation.cache_hit,
+                usage=evaluation.usage,
+                output_sizes=evaluation.output_sizes,
+                timed_out=evaluation.timed_out,
+            )
+            # timeouts may be due to load, so they are not reused
+            if evaluation.input_digest and not evaluation.timed_out:
+                CachedEvaluation.objects.update_or_create(
+                    digest=evaluation.input_digest,
+                    defaults={
+                        'stdout': evaluation.stdout,
+                        'stderr': evaluation.stderr,
+                        'return_code': evaluation.return_code,
+                    },
+                )
+    # the Results are already saved, so they should not be evaluated again if
+    # Redis is unavailable; pages that miss the announcement still show the
+    # Results when they are reloaded
+    try:
+        record_throughput(len(evaluations))
+        publish_evaluations(evaluations)
+    except RedisError:
+        pass
+
+
+def save_evaluations_with_retry(evaluations):
+    """Save evaluations, waiting for the database if it is locked.
+
+    The evaluations have already been run, so instead of redoing them when the
+    database is busy, the write is retried with exponential backoff (and some
+    jitter, so that workers do not retry in lockstep).
+
+    Raises:
+        OperationalError: if the database is still locked after all attempts
+    """
+    for attempt in range(settings.DATABASE_WRITE_ATTEMPTS):
+        try:
+            save_evaluations(evaluations)
+            return
+        except (SQLiteOperationalError, DjangoOperationalError):
+            if attempt + 1 == settings.DATABASE_WRITE_ATTEMPTS:
+                raise
+            sleep(settings.DATABASE_WRITE_DELAY * 2**attempt * (1 + random()))
+
+
+def serialize_evaluation(evaluation):
+    return json.dumps({
+        'result': evaluation.result.id,
+        'stdout': evaluation.stdout,
+        'stderr': evaluation.stderr,
+        'return_code': evaluation.return_code,
+        'cache_hit': evaluation.cache_hit,
+        'input_digest': evaluation.input_digest,
+        'usage': evaluation.usage,
+        'output_sizes': evaluation.output_sizes,
+        'timed_out': evaluation.timed_out,
+    })
+
+
+def deserialize_evaluations(data):
+    """Rebuild evaluations sent to the result sink, skipping deleted Results."""
+    evaluations = [json.loads(datum) for datum in data]
+    results = Result.objects.in_bulk([evaluation['result'] for evaluation in evaluations])
+    return [
+        Evaluation(
+            results[evaluation['result']],
+            evaluation['stdout'],
+            evaluation['stderr'],
+            evaluation['return_code'],
+            evaluation['cache_hit'],
+            evaluation['input_digest'],
+            (Usage(*evaluation['usage']) if evaluation['usage'] else None),
+            (tuple(evaluation['output_sizes']) if evaluation['output_sizes'] else None),
+            evaluation['timed_out'],
+        )
+        for evaluation in evaluations
+        if evaluation['result'] in results
+    ]
+
+
+def store_evaluations(evaluations):
+    """Save evaluations, or send them to the result sink if there is one."""
+    if settings.RESULT_SINK:
+        if evaluations:
+            get_connection().rpush(RESULT_SINK_KEY, *(serialize_evaluation(evaluation) for evaluation in evaluations))
+    else:
+        save_evaluations_with_retry(evaluations)
+
+
+def get_current_priority():
+    job = get_current_job()
+    if job is not None and job.origin in PRIORITIES:
+        return job.origin
+    return INTERACTIVE
+
+
+def evaluate_submissions(result_ids, use_cache=True):
+    # from now on, requests to evaluate these Results need a new job
+    release('evaluate', result_ids)
     try:
-        result = Result.objects.get(pk=result_id)
-        timeout = result.project.timeout
-        # create temporary directory
-        with TemporaryDirectory() as temp_dir:
-            cmd = prepare_files(result, temp_dir, timeout)
-            old_cwd = getcwd()
-            chdir(temp_dir)
-            completed_process = run_process(cmd, stderr=PIPE, stdout=PIPE, check=False)
-            stdout = completed_process.stdout.decode('utf-8')[:2**16]
-            stderr = completed_process.stderr.decode('utf-8')[:2**16]
-            return_code = completed_process.returncode
-            if return_code == -9: # from timeout
-                stderr += '\n\n'
-                stderr += 'The program failed to complete within {} seconds and was terminated.'.format(timeout)
-                stderr = stderr.strip()
-            chdir(old_cwd)
-        # update Result
-        result.stdout = stdout.strip()
-        result.stderr = stderr.strip()
-        result.return_code = return_code
-        result.save()
-    except (SQLiteOperationalError, DjangoOperationalError):
-        enqueue_submission_evaluation(result_id)
+        try:
+            evaluations, plans = plan_evaluations(result_ids, use_cache=use_cache)
+        except (SQLiteOperationalError, DjangoOperationalError):
+            # nothing has been run yet, so try again later
+            enqueue_submission_evaluations(result_ids, priority=get_current_priority(), use_cache=use_cache)
+            return
+        for plan in plans:
+            evaluations.extend(run_sandbox(plan))
+        try:
+            store_evaluations(evaluations)
+        except (SQLiteOperationalError, DjangoOperationalError):
+            # as a last resort; the Results are otherwise left TBD
+            enqueue_submission_evaluations(result_ids, priority=get_current_priority(), use_cache=use_cache)
+    finally:
+        # make room in the queues for the next waiting jobs
+        pump()
+
+
+def evaluate_submission(result_id, use_cache=True):
+    evaluate_submissions([result_id], use_cache=use_cache)
+
+
+def enqueue_submission_evaluation(result_id, priority=INTERACTIVE, use_cache=True):
+    enqueue_submission_evaluations([result_id], priority=priority, use_cache=use_cache)
+
+
+def enqueue_submission_evaluations(result_ids, priority=INTERACTIVE, use_cache=True):
+    """Schedule the evaluation of some Results.
+
+    The Results are split by student, so that the scheduler can share the
+    workers fairly between courses and students.
+
+    Parameters:
+        result_ids ([int]): the IDs of the Results to evaluate
+        priority (str): the priority class of the evaluations
+        use_cache (bool): whether Results may be taken from the cache
+    """
+    # Results that are already waiting to be evaluated are left to that job
+    result_ids = claim('evaluate', result_ids)
+    if not result_ids:
         return
-
-
-def enqueue_submission_evaluation(result_id):
-    django_rq.get_queue('evaluation').enqueue(evaluate_submission, result_id)
+    rows = Result.objects.filter(pk__in=result_ids).order_by('id').values_list(
+        'id', 'submission', 'submission__student', 'submission__project__assignment__course',
+    )
+    batch_size = settings.EVALUATION_BATCH_SIZE
+    for (course_id, student_id), submission_result_ids in group_by_flow(rows).items():
+        # batches do not span submissions, so that superseding a submission
+        # can cancel its jobs outright
+        batches = []
+        for batch_result_ids in submission_result_ids.values():
+            batches.extend(
+                batch_result_ids[start:start + batch_size]
+                for start in range(0, len(batch_result_ids), batch_size)
+            )
+        if batch_size > 1:
+            jobs = [(evaluate_submissions, (batch, use_cache)) for batch in batches]
+        else:
+            jobs = [(evaluate_submission, (batch[0], use_cache)) for batch in batches]
+        schedule(priority, course_id, student_id, jobs, batches)
 
 
 def get_relevant_submissions(person, project):
-    try:
-        if project.submission_type == Project.LATEST:
-            return (person.submissions().filter(project=project).latest(), )
-        elif project.submission_type == Project.ALL:
-            return tuple(person.submissions().filter(project=project))
-        # FIXME deal with other submission types
-        return tuple()
-    except Submission.DoesNotExist:
-        return tuple()
-
-
-def dispatch_submission(submission_id):
-    submission = Submission.objects.get(pk=submission_id)
+    if project.submission_type == Project.LATEST:
+        submission = person.latest_submission(project)
+        if submission:
+            return (submission, )
+        else:
+            return tuple()
+    elif project.submission_type == Project.ALL:
+        return tuple(person.submissions().filter(project=project))
+    # FIXME deal with other submission types
+    return tuple()
+
+
+def get_clique_submissions(course, project):
+    if project.submission_type == Project.LATEST:
+        students = [course.instructor_id, *course.enrolled_students().values_list('id', flat=True)]
+        return tuple(project.latest_submissions(students=students).values())
+    submissions = set(get_relevant_submissions(course.instructor, project))
+    for classmate in course.enrolled_students():
+        submissions.update(get_relevant_submissions(classmate, project))
+    return tuple(submissions)
+
+
+def get_dependents(submission, project_dependencies):
+    """Find the upstream submissions that a submission should be tested with.
+
+    Parameters:
+        submission (Submission): the downstream submission
+        project_dependencies (list): the ProjectDependencies of its project
+
+    Returns:
+        dict: from ProjectDependency to a list of upstream Submissions
+    """
     project = submission.project
-    if not project.script:
-        return
     student = submission.student
-    project_dependencies = sorted(project.upstream_dependencies(), key=(lambda pd: pd.keyword))
     dependents = defaultdict(set)
     for project_dependency in project_dependencies:
         if project_dependency.dependency_structure == ProjectDependency.SELF:
@@ -113,68 +577,248 @@ def dispatch_submission(submission_id):
                 get_relevant_submissions(project.course.instructor, project_dependency.producer)
             )
         elif project_dependency.dependency_structure == ProjectDependency.CLIQUE:
-            dependents[project_dependency].update(
-                get_relevant_submissions(project.course.instructor, project_dependency.producer)
-            )
-            for classmate in project.course.enrolled_students():
-                dependents[project_dependency].update(get_relevant_submissions(classmate, project_dependency.producer))
+            dependents[project_dependency].update(get_clique_submissions(project.course, project_dependency.producer))
         elif project_dependency.dependency_structure == ProjectDependency.CUSTOM:
             pass # FIXME not implemented
     for dependency, submissions in dependents.items():
         dependents[dependency] = sorted(submissions, key=(lambda submission: submission.timestamp))
-    count = 0
-    for dependent_submissions in product(*(dependents[pd] for pd in project_dependencies)):
-        result = Result(submission=submission)
-        result.save()
-        kwargs = dict(zip(project_dependencies, dependent_submissions))
-        for project_dependency, upstream_submission in kwargs.items():
-            ResultDependency(
-                result=result,
-                project_dependency=project_dependency,
-                producer=upstream_submission,
-            ).save()
-        enqueue_submission_evaluation(result.id)
-        count += 1
-        # TODO 200 was arbitrarily chosen; in the future this should be a project property
-        if count == 200:
-            break
+    return dependents
 
 
-def enqueue_submission_dispatch(submission_id):
-    submission = Submission.objects.get(pk=submission_id)
-    submission.result_set.all().delete()
-    django_rq.get_queue('dispatch').enqueue(dispatch_submission, submission_id)
+def dispatch_results(submission, project_dependencies, combinations, priority=INTERACTIVE, use_cache=True, generation=None):
+    chunk_size = max(DISPATCH_CHUNK_SIZE, settings.EVALUATION_BATCH_SIZE)
+    combinations = iter(combinations)
+    while True:
+        chunk = list(islice(combinations, chunk_size))
+        if not chunk:
+            break
+        result_ids = create_results(submission, project_dependencies, chunk, generation=generation)
+        if result_ids is None:
+            # a regrade has started over
+            break
+        enqueue_submission_evaluations(result_ids, priority=priority, use_cache=use_cache)
 
 
-def dispatch_project(project_id):
+def dispatch_submission(submission_id, priority=INTERACTIVE, use_cache=True, generation=None):
+    if generation is not None and is_superseded('dispatch_submission', submission_id, generation):
+        return
+    submission = Submission.objects.get(pk=submission_id)
+    project = submission.project
+    if not project.script:
+        return
+    project_dependencies = sorted(project.upstream_dependencies(), key=(lambda pd: pd.keyword))
+    dependents = get_dependents(submission, project_dependencies)
+    combinations = islice(product(*(dependents[pd] for pd in project_dependencies)), MAX_RESULTS)
+    dispatch_results(
+        submission, project_dependencies, combinations, priority=priority, use_cache=use_cache, generation=generation,
+    )
+
+
+def create_results(submission, project_dependencies, combinations, generation=None):
+    """Create the Results for a submission in bulk.
+
+    The Results, their ResultDependencies, and the update to the TBD count of
+    the submission are all written in one transaction.
+
+    Parameters:
+        submission (Submission): the submission to create Results for
+        project_dependencies (list): the ProjectDependencies of the project
+        combinations (list): for each Result, a tuple of upstream submissions,
+            in the same order as project_dependencies
+        generation (int): if given, the generation of the dispatch creating
+            the Results, which creates nothing once it has been superseded
+
+    Returns:
+        [int]: the IDs of the created Results, or None if the dispatch has
+            been superseded
+    """
+    with transaction.atomic():
+        # a regrade deletes the Results with the submission locked, so it
+        # cannot miss Results created after it superseded this dispatch
+        list(Submission.objects.select_for_update().filter(pk=submission.pk).values_list('id', flat=True))
+        results = Result.objects.bulk_create(Result(submission=submission) for _ in combinations)
+        if results and results[0].pk is None:
+            # the backend (eg. SQLite) does not return IDs from bulk inserts;
+            # since this transaction holds the write lock, the new Results are
+            # the ones with the largest IDs
+            result_ids = Result.objects.filter(submission=submission).order_by('-id').values_list('id', flat=True)
+            result_ids = sorted(result_ids[:len(results)])
+        else:
+            result_ids = [result.pk for result in results]
+        ResultDependency.objects.bulk_create(
+            ResultDependency(
+                result_id=result_id,
+                project_dependency=project_dependency,
+                producer=upstream_submission,
+            )
+            for result_id, dependent_submissions in zip(result_ids, combinations)
+            for project_dependency, upstream_submission in zip(project_dependencies, dependent_submissions)
+        )
+        Submission.objects.filter(pk=submission.pk).update(num_tbd=F('num_tbd') + len(result_ids))
+        # checked after writing, so that (on SQLite) this transaction already
+        # holds the write lock that the regrade needs to delete the Results
+        if generation is not None and is_superseded('dispatch_submission', submission.pk, generation):
+            transaction.set_rollback(True)
+            return None
+    return result_ids
+
+
+def enqueue_submission_dispatch(submission_id, priority=INTERACTIVE, use_cache=True):
+    """Delete the Results of a submission and dispatch it again.
+
+    A dispatch of the submission that is still creating Results stops before
+    its next chunk, and one that is still waiting does nothing, so only the
+    new dispatch creates Results.
+
+    Parameters:
+        submission_id (int): the ID of the submission
+        priority (str): the priority class of the evaluations
+        use_cache (bool): whether Results may be taken from the cache
+    """
+    generation = advance_generation('dispatch_submission', submission_id)
+    with transaction.atomic():
+        submission = Submission.objects.select_for_update().get(pk=submission_id)
+        result_ids = list(submission.result_set.values_list('id', flat=True))
+        submission.result_set.all().delete()
+        Submission.objects.filter(pk=submission_id).update(num_passed=0, num_failed=0, num_tbd=0)
+    # the old Results are gone, so there is no point in evaluating them
+    cancel_evaluations(result_ids)
+    django_rq.get_queue('dispatch').enqueue(dispatch_submission, submission_id, priority, use_cache, generation)
+
+
+def retire_results(consumer, project_dependency, producer):
+    """Delete the Results of a submission that used a superseded producer.
+
+    Parameters:
+        consumer (Submission): the downstream submission
+        project_dependency (ProjectDependency): the dependency to the producer
+        producer (Submission): the superseded upstream submission
+
+    Returns:
+        [dict]: for each deleted Result, a map from ProjectDependency ID to
+            the ID of the upstream Submission it was tested with
+    """
+    stale_results = Result.objects.filter(
+        submission=consumer,
+        resultdependency__project_dependency=project_dependency,
+        resultdependency__producer=producer,
+    )
+    stale_dependencies = defaultdict(dict)
+    result_dependencies = ResultDependency.objects.filter(result__in=stale_results).values_list(
+        'result', 'project_dependency', 'producer',
+    )
+    for result_id, project_dependency_id, producer_id in result_dependencies:
+        stale_dependencies[result_id][project_dependency_id] = producer_id
+    Result.objects.filter(id__in=list(stale_dependencies)).delete()
+    cancel_evaluations(list(stale_dependencies))
+    return list(stale_dependencies.values())
+
+
+def dispatch_downstream(submission_id):
+    """Update dependent projects after a new submission to a producer project.
+
+    Under a CLIQUE dependency, the latest submission of every student in the
+    course is tested with everyone's submissions to the producer. Instead of
+    regrading the whole dependent project, only the new pairings are created:
+    each consumer's latest submission is tested with the new submission, and
+    if the producer only uses the latest submission, the Results that used
+    the student's previous submission are retired.
+
+    Parameters:
+        submission_id (int): the ID of the new producer submission
+    """
+    release('dispatch_downstream', [submission_id])
+    submission = Submission.objects.select_related('project').get(pk=submission_id)
+    producer = submission.project
+    previous = None
+    if producer.submission_type == Project.LATEST:
+        previous = Submission.objects.filter(
+            student=submission.student,
+            project=producer,
+            timestamp__lt=submission.timestamp,
+        ).first()
+    downstream_dependencies = producer.downstream_dependencies().filter(
+        dependency_structure=ProjectDependency.CLIQUE,
+    ).select_related('project')
+    for project_dependency in downstream_dependencies:
+        project = project_dependency.project
+        if not project.script:
+            continue
+        course = project.course
+        students = [course.instructor_id, *course.enrolled_students().values_list('id', flat=True)]
+        if submission.student_id not in students:
+            continue
+        project_dependencies = sorted(project.upstream_dependencies(), key=(lambda pd: pd.keyword))
+        for consumer in project.latest_submissions(students=students).values():
+            if consumer.result_set.filter(resultdependency__producer=submission).exists():
+                # the consumer was dispatched after this submission was made
+                continue
+            with transaction.atomic():
+                stale_dependencies = []
+                if previous:
+                    stale_dependencies = retire_results(consumer, project_dependency, previous)
+                    consumer.recount_results()
+                if stale_dependencies:
+                    # keep the other dependencies of each retired Result
+                    upstream_submissions = Submission.objects.in_bulk(
+                        {producer_id for dependencies in stale_dependencies for producer_id in dependencies.values()}
+                    )
+                    combinations = [
+                        tuple(
+                            submission if pd == project_dependency else upstream_submissions[dependencies[pd.id]]
+                            for pd in project_dependencies
+                        )
+                        for dependencies in stale_dependencies
+                        if all(pd.id in dependencies for pd in project_dependencies)
+                    ]
+                else:
+                    dependents = get_dependents(consumer, project_dependencies)
+                    dependents[project_dependency] = [submission]
+                    combinations = product(*(dependents[pd] for pd in project_dependencies))
+                num_results = consumer.num_passed + consumer.num_failed + consumer.num_tbd
+                combinations = list(islice(combinations, max(0, MAX_RESULTS - num_results)))
+                result_ids = []
+                if combinations:
+                    result_ids = create_results(consumer, project_dependencies, combinations)
+            # these are other students' submissions, so they do not get to
+            # jump ahead of interactive evaluations
+            enqueue_submission_evaluations(result_ids, priority=REGRADE)
+
+
+def enqueue_downstream_dispatch(submission_id):
+    enqueue_once('dispatch', 'dispatch_downstream', submission_id, dispatch_downstream, submission_id)
+
+
+def dispatch_project(project_id, use_cache=True):
+    release('dispatch_project', [project_id])
     project = Project.objects.get(pk=project_id)
-    for student in project.course.enrolled_students():
-        submission = student.latest_submission(project=project)
-        if submission:
-            enqueue_submission_dispatch(submission.id)
+    for submission in project.latest_submissions(students=project.course.enrolled_students()).values():
+        enqueue_submission_dispatch(submission.id, priority=REGRADE, use_cache=use_cache)
 
 
-def enqueue_project_dispatch(project_id):
-    django_rq.get_queue('dispatch').enqueue(dispatch_project, project_id)
+def enqueue_project_dispatch(project_id, use_cache=True):
+    enqueue_once('dispatch', 'dispatch_project', project_id, dispatch_project, project_id, use_cache)
 
 
-def dispatch_assignment(assignment_id):
+def dispatch_assignment(assignment_id, use_cache=True):
+    release('dispatch_assignment', [assignment_id])
     for project in Assignment.objects.get(pk=assignment_id).projects():
-        enqueue_project_dispatch(project.id)
+        enqueue_project_dispatch(project.id, use_cache=use_cache)
 
 
-def enqueue_assignment_dispatch(assignment_id):
-    django_rq.get_queue('dispatch').enqueue(dispatch_assignment, assignment_id)
+def enqueue_assignment_dispatch(assignment_id, use_cache=True):
+    enqueue_once('dispatch', 'dispatch_assignment', assignment_id, dispatch_assignment, assignment_id, use_cache)
 
 
 def dispatch_tbd():
-    for result in Result.objects.filter(return_code=None):
-        enqueue_submission_evaluation(result.id)
+    release('dispatch_tbd', [0])
+    result_ids = Result.objects.filter(return_code=None).values_list('id', flat=True)
+    enqueue_submission_evaluations(list(result_ids), priority=RECOVERY)
 
 
 def enqueue_tbd_dispatch():
-    django_rq.get_queue('dispatch').enqueue(dispatch_tbd)
+    enqueue_once('dispatch', 'dispatch_tbd', 0, dispatch_tbd)
 
 
 def clear_evaluation_queue():
-    django_rq.get_queue('evaluation').empty()
+    clear()
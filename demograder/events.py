@@ -0,0 +1,123 @@
+import json
+from time import monotonic
+
+from django.db import connection
+
+from .models import Submission, Result
+from .scheduler import get_connection
+
+CHANNEL_PREFIX = 'demograder:events:submission'
+
+
+def _channel(submission_id):
+    return '{}:{}'.format(CHANNEL_PREFIX, submission_id)
+
+
+def _get_state(submission, results):
+    """Describe a Submission for the pages watching it.
+
+    Parameters:
+        submission (dict): the Submission ID and counts
+        results ([(int, int)]): the IDs and return codes of finished Results
+
+    Returns:
+        dict: the counts, and whether each Result passed
+    """
+    return {
+        'submission': submission['id'],
+        'num_passed': submission['num_passed'],
+        'num_failed': submission['num_failed'],
+        'num_tbd': submission['num_tbd'],
+        'results': {
+            str(result_id): ('pass' if return_code == 0 else 'fail')
+            for result_id, return_code in results
+        },
+    }
+
+
+def publish_evaluations(evaluations):
+    """Announce saved evaluations to the pages watching their Submissions.
+
+    Parameters:
+        evaluations ([Evaluation]): the evaluations that were saved
+    """
+    results_by_submission = {}
+    for evaluation in evaluations:
+        results_by_submission.setdefault(evaluation.result.submission_id, []).append(
+            (evaluation.result.id, evaluation.return_code)
+        )
+    submissions = Submission.objects.filter(id__in=results_by_submission).values(
+        'id', 'num_passed', 'num_failed', 'num_tbd',
+    )
+    pipeline = get_connection().pipeline(transaction=False)
+    for submission in submissions:
+        state = _get_state(submission, results_by_submission[submission['id']])
+        pipeline.publish(_channel(submission['id']), json.dumps(state))
+    pipeline.execute()
+
+
+def _format_event(event, data):
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+
+
+def stream_submission_events(submission_id, lifetime, heartbeat):
+    """Generate Server-Sent Events as the Results of a Submission finish.
+
+    The first event describes all finished Results; later events only
+    describe the newly finished ones. The stream ends with a "done" event when
+    no Results are left, or after `lifetime` seconds, after which the browser
+    reconnects. Comments are sent every `heartbeat` seconds to keep proxies
+    from closing the connection.
+
+    The database is only read before the first event, so that open streams
+    only hold a Redis connection.
+
+    Parameters:
+        submission_id (int): the ID of the Submission
+        lifetime (float): the maximum number of seconds to stream for
+        heartbeat (float): the number of seconds between keep-alive comments
+
+    Yields:
+        str: the text of each event
+    """
+    pubsub = get_connection().pubsub(ignore_subscribe_messages=True)
+    # subscribe before reading the state, so that no Result is missed
+    pubsub.subscribe(_channel(submission_id))
+    try:
+        submission = Submission.objects.filter(id=submission_id).values(
+            'id', 'num_passed', 'num_failed', 'num_tbd',
+        ).first()
+        results = []
+        if submission is not None:
+            results = list(Result.objects.filter(submission_id=submission_id).exclude(
+                return_code=None,
+            ).values_list('id', 'return_code'))
+        # give the connection back (eg. to PostgreSQL) instead of holding it
+        # for the whole stream
+        connection.close()
+        if submission is None:
+            yield _format_event('done', {})
+            return
+        yield 'retry: 1000\n\n'
+        yield _format_event('result', _get_state(submission, results))
+        if submission['num_tbd'] == 0:
+            yield _format_event('done', {})
+            return
+        deadline = monotonic() + lifetime
+        last_sent = monotonic()
+        while monotonic() < deadline:
+            timeout = min(heartbeat, deadline - monotonic())
+            message = pubsub.get_message(timeout=max(timeout, 0))
+            if message is None or message['type'] != 'message':
+                if monotonic() - last_sent >= heartbeat:
+                    yield ': keep-alive\n\n'
+                    last_sent = monotonic()
+                continue
+            state = json.loads(message['data'])
+            yield _format_event('result', state)
+            last_sent = monotonic()
+            if state['num_tbd'] == 0:
+                yield _format_event('done', {})
+                return
+    finally:
+        pubsub.close()
@@ -0,0 +1,276 @@
+import csv
+import json
+from itertools import islice
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.text import get_valid_filename
+
+from .gradebook import build_gradebook, get_score
+from .models import Upload
+
+CHUNK_SIZE = 500
+FILE_CHUNK_SIZE = 2**16
+
+RESULT_FIELDS = (
+    ('result', 'id'),
+    ('submission', 'submission_id'),
+    ('student', 'submission__student__user__username'),
+    ('assignment', 'submission__project__assignment__name'),
+    ('project', 'submission__project__name'),
+    ('submission_time', 'submission__timestamp'),
+    ('result_time', 'timestamp'),
+    ('return_code', 'return_code'),
+    ('timed_out', 'timed_out'),
+    ('cache_hit', 'cache_hit'),
+    ('wall_time', 'wall_time'),
+    ('user_time', 'user_time'),
+    ('system_time', 'system_time'),
+    ('max_rss', 'max_rss'),
+    ('stdout_size', 'stdout_size'),
+    ('stderr_size', 'stderr_size'),
+    ('stdout', 'stdout'),
+    ('stderr', 'stderr'),
+)
+
+
+class _Echo:
+    """A file-like object that returns what is written to it, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(header, rows):
+    """Generate the lines of a CSV file.
+
+    Parameters:
+        header (list): the column names
+        rows (iterable): the rows, each a list of values
+
+    Yields:
+        str: the header, then each row
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_json(objects):
+    """Generate a JSON array, one element at a time.
+
+    Parameters:
+        objects (iterable): the elements of the array
+
+    Yields:
+        str: the pieces of the array
+    """
+    yield '['
+    for index, obj in enumerate(objects):
+        yield (',\n' if index else '\n') + json.dumps(obj, cls=DjangoJSONEncoder)
+    yield '\n]\n'
+
+
+def iterate_gradebook(students, projects, chunk_size=CHUNK_SIZE):
+    """Build the gradebook a chunk of students at a time.
+
+    Parameters:
+        students (QuerySet): the students (Person) in the gradebook
+        projects ([Project]): the projects in the gradebook
+        chunk_size (int): the number of students fetched at a time
+
+    Yields:
+        GradebookRow: one row per student
+    """
+    students = students.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(students, chunk_size))
+        if not chunk:
+            return
+        yield from build_gradebook(chunk, projects)
+
+
+def get_project_label(project):
+    return '{}: {}'.format(project.assignment.name, project.name)
+
+
+def stream_grades_csv(students, projects):
+    """Generate a CSV gradebook, with the score of each project and the grade.
+
+    Parameters:
+        students (QuerySet): the students (Person) in the gradebook
+        projects ([Project]): the projects in the gradebook
+
+    Yields:
+        str: the lines of the CSV file
+    """
+    header = ['username', 'last_name', 'first_name']
+    header.extend(get_project_label(project) for project in projects)
+    header.append('grade')
+    rows = (
+        [row.student.username, row.student.last_name, row.student.first_name]
+        + [get_score(submission) for submission in row.submissions]
+        + [row.grade]
+        for row in iterate_gradebook(students, projects)
+    )
+    return stream_csv(header, rows)
+
+
+def stream_grades_json(students, projects):
+    """Generate a JSON gradebook, with the Result counts of each project.
+
+    Parameters:
+        students (QuerySet): the students (Person) in the gradebook
+        projects ([Project]): the projects in the gradebook
+
+    Yields:
+        str: the pieces of the JSON array
+    """
+    objects = (
+        {
+            'username': row.student.username,
+            'last_name': row.student.last_name,
+            'first_name': row.student.first_name,
+            'projects': [
+                {
+                    'assignment': project.assignment.name,
+                    'project': project.name,
+                    'submission_time': submission.iso_format or None,
+                    'passed': submission.num_passed,
+                    'failed': submission.num_failed,
+                    'tbd': submission.num_tbd,
+                    'score': get_score(submission),
+                }
+                for project, submission in zip(projects, row.submissions)
+            ],
+            'grade': row.grade,
+        }
+        for row in iterate_gradebook(students, projects)
+    )
+    return stream_json(objects)
+
+
+def get_result_rows(results, chunk_size=CHUNK_SIZE):
+    """Fetch Results with their submission details, a chunk at a time.
+
+    Parameters:
+        results (QuerySet): the Results to export
+        chunk_size (int): the number of Results fetched at a time
+
+    Yields:
+        tuple: the values of RESULT_FIELDS
+    """
+    return results.order_by('id').values_list(
+        *(field for _, field in RESULT_FIELDS)
+    ).iterator(chunk_size=chunk_size)
+
+
+def stream_results_csv(results):
+    return stream_csv([name for name, _ in RESULT_FIELDS], get_result_rows(results))
+
+
+def stream_results_json(results):
+    names = [name for name, _ in RESULT_FIELDS]
+    return stream_json(dict(zip(names, row)) for row in get_result_rows(results))
+
+
+class _ZipStream:
+    """An unseekable file-like object whose contents are taken as they are written.
+
+    ZipFile writes to unseekable files by putting the size of each member
+    after its data, so the archive can be sent as it is built.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def get_uploads(projects, latest_only=True):
+    """Get the uploads to projects, in the order they are archived.
+
+    Parameters:
+        projects ([Project]): the projects to get uploads to
+        latest_only (bool): only include each student's latest submission
+
+    Returns:
+        QuerySet: the Uploads, by student, project, and submission time
+    """
+    if latest_only:
+        uploads = Upload.objects.filter(submission__latestsubmission__project__in=projects)
+    else:
+        uploads = Upload.objects.filter(submission__project__in=projects)
+    return uploads.select_related(
+        'submission__student__user', 'submission__project', 'project_file',
+    ).order_by(
+        'submission__student__user__username', 'submission__project__name', 'submission__timestamp', 'id',
+    )
+
+
+def get_archive_name(name):
+    """Make a name safe to use as one component of a path in an archive."""
+    # get_valid_filename removes slashes and backslashes, but keeps dots
+    name = get_valid_filename(name)
+    if name in ('', '.', '..'):
+        name = '_'
+    return name
+
+
+def get_archive_path(root, upload, latest_only=True):
+    submission = upload.submission
+    parts = [root, submission.student.username, submission.project.name]
+    if not latest_only:
+        parts.append('{}-{}'.format(submission.timestamp.strftime('%Y%m%d-%H%M%S'), submission.id))
+    parts.append(upload.project_file.filename)
+    return '/'.join(get_archive_name(part) for part in parts)
+
+
+def stream_uploads_zip(uploads, root, latest_only=True):
+    """Generate a zip archive of uploads, laid out by student and project.
+
+    Only one chunk of a file is held in memory at a time, and nothing is
+    written to disk. Uploads whose files are missing are left out.
+
+    Parameters:
+        uploads (QuerySet): the Uploads to archive, from get_uploads()
+        root (str): the name of the top directory in the archive
+        latest_only (bool): whether the uploads are only from the latest
+            submissions; if not, each submission gets its own directory
+
+    Yields:
+        bytes: the pieces of the archive
+    """
+    stream = _ZipStream()
+    with ZipFile(stream, 'w', ZIP_DEFLATED) as archive:
+        for upload in uploads.iterator(chunk_size=CHUNK_SIZE):
+            try:
+                source = open(upload.file.name, 'rb')
+            except OSError:
+                continue
+            info = ZipInfo(
+                get_archive_path(root, upload, latest_only=latest_only),
+                date_time=upload.submission.timestamp.timetuple()[:6],
+            )
+            info.compress_type = ZIP_DEFLATED
+            with source, archive.open(info, 'w') as member:
+                for chunk in iter(lambda: source.read(FILE_CHUNK_SIZE), b''):
+                    member.write(chunk)
+                    data = stream.take()
+                    if data:
+                        yield data
+            data = stream.take()
+            if data:
+                yield data
+    yield stream.take()
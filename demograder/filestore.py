@@ -0,0 +1,129 @@
+from hashlib import sha256
+from os import chmod, link, makedirs, rename, scandir, unlink
+from os.path import dirname, exists, join as join_path, lexists
+from shutil import copyfile
+from tempfile import mkstemp
+from uuid import uuid4
+
+from .models import UPLOAD_PATH, Upload
+
+STORE_PATH = join_path(UPLOAD_PATH, 'store')
+SANDBOX_PATH = join_path(UPLOAD_PATH, 'sandboxes')
+
+# blobs are shared between uploads and sandboxes, so nobody may write to them
+BLOB_MODE = 0o555
+# sandboxes reach blobs through their own hard links, so only the owner of the
+# store needs to be able to find them
+STORE_MODE = 0o700
+CHUNK_SIZE = 2**16
+
+
+def file_digest(path):
+    digest = sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_path(digest):
+    return join_path(STORE_PATH, digest[:2], digest[2:])
+
+
+def make_blob_dir(blob):
+    """Create the directory of a blob, which only the owner of the store can access.
+
+    Parameters:
+        blob (str): the path of the blob in the store
+    """
+    blob_dir = dirname(blob)
+    makedirs(blob_dir, mode=STORE_MODE, exist_ok=True)
+    # makedirs() only sets the mode of directories it creates, and only of the last one
+    chmod(STORE_PATH, STORE_MODE)
+    chmod(blob_dir, STORE_MODE)
+
+
+def restrict_store():
+    """Make the directories of an existing store only accessible to its owner."""
+    if not exists(STORE_PATH):
+        return
+    chmod(STORE_PATH, STORE_MODE)
+    for entry in scandir(STORE_PATH):
+        if entry.is_dir(follow_symlinks=False):
+            chmod(entry.path, STORE_MODE)
+
+
+def store_file(path):
+    """Add a file to the content-addressed store.
+
+    If the store already contains a file with the same contents, the file is
+    replaced by a hard link to it, so that identical files only take up space
+    once. Either way, the file is made read-only.
+
+    Parameters:
+        path (str): the path of the file to store
+
+    Returns:
+        str: the SHA-256 digest of the file
+    """
+    digest = file_digest(path)
+    blob = blob_path(digest)
+    make_blob_dir(blob)
+    try:
+        link(path, blob)
+    except FileExistsError:
+        # a unique name, so that a link left by an interrupted store does
+        # not get in the way
+        temp_path = '{}.{}.link'.format(path, uuid4().hex)
+        link(blob, temp_path)
+        rename(temp_path, path)
+    chmod(blob, BLOB_MODE)
+    return digest
+
+
+def store_contents(contents):
+    """Add a byte string to the content-addressed store.
+
+    Parameters:
+        contents (bytes): the contents to store
+
+    Returns:
+        str: the path of the blob in the store
+    """
+    blob = blob_path(sha256(contents).hexdigest())
+    if exists(blob):
+        return blob
+    make_blob_dir(blob)
+    fd, temp_path = mkstemp(dir=dirname(blob))
+    try:
+        with open(fd, 'wb') as out_fd:
+            out_fd.write(contents)
+        chmod(temp_path, BLOB_MODE)
+        rename(temp_path, blob)
+    except OSError:
+        unlink(temp_path)
+        raise
+    return blob
+
+
+def link_file(source, destination):
+    """Populate a sandbox file, sharing storage with the source if possible.
+
+    Parameters:
+        source (str): the path of a stored (read-only) file
+        destination (str): the path of the file in the sandbox
+    """
+    if lexists(destination):
+        # later files (eg. from dependencies) replace earlier ones of the same name
+        unlink(destination)
+    try:
+        link(source, destination)
+    except OSError:
+        # not on the same file system
+        copyfile(source, destination)
+        chmod(destination, BLOB_MODE)
+
+
+def store_upload(upload):
+    upload.digest = store_file(upload.file.name)
+    Upload.objects.filter(pk=upload.pk).update(digest=upload.digest)
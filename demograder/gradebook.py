@@ -0,0 +1,115 @@
+from collections import namedtuple
+
+from .models import Course
+
+SubmissionDisplay = namedtuple(
+    'SubmissionDisplay',
+    [
+        'student',
+        'project',
+        'iso_format',
+        'num_passed',
+        'num_tbd',
+        'num_failed',
+        'max_score',
+        'score_str',
+    ],
+)
+
+GradebookRow = namedtuple('GradebookRow', ('student', 'submissions', 'grade'))
+
+
+def get_latest_submissions(students, projects):
+    """Get the latest submission of every student to every project.
+
+    This uses Project.latest_submissions() for a single project, and otherwise
+    Course.latest_submissions() for each course the projects are in, so it
+    takes one query per course against the LatestSubmission index; the
+    pass/fail counts come along for free as they are stored on the Submission.
+
+    Parameters:
+        students (iterable): the students (Person) to include
+        projects (iterable): the projects to include
+
+    Returns:
+        dict: from (student ID, project ID) to Submission
+    """
+    student_ids = [student.id for student in students]
+    projects = list(projects)
+    if len(projects) == 1:
+        project = projects[0]
+        return {
+            (student_id, project.id): submission
+            for student_id, submission in project.latest_submissions(student_ids).items()
+        }
+    project_ids = set(project.id for project in projects)
+    latest_submissions = {}
+    for course in Course.objects.filter(assignment__project__in=project_ids).distinct().order_by():
+        latest_submissions.update(
+            (key, submission)
+            for key, submission in course.latest_submissions(student_ids).items()
+            if key[1] in project_ids
+        )
+    return latest_submissions
+
+
+def get_submission_displays(student, projects, latest_submissions):
+    displays = []
+    for project in projects:
+        submission = latest_submissions.get((student.id, project.id))
+        if submission:
+            # reuse the already-fetched objects to avoid a query per cell
+            submission.student = student
+            submission.project = project
+            displays.append(submission)
+        else:
+            displays.append(SubmissionDisplay(student, project, '', 0, 0, 0, 0, ''))
+    return displays
+
+
+def get_score(submission):
+    if submission is None or submission.max_score == 0:
+        return 0
+    return submission.score / submission.max_score
+
+
+def get_grade(student, projects, latest_submissions):
+    """Calculate a student's grade as the average score over visible projects.
+
+    Parameters:
+        student (Person): the student to calculate the grade for
+        projects (iterable): the projects that make up the grade
+        latest_submissions (dict): the result of get_latest_submissions()
+
+    Returns:
+        float: the grade, between 0 and 1
+    """
+    graded_projects = [project for project in projects if project.visible]
+    if not graded_projects:
+        return 0
+    total = sum(get_score(latest_submissions.get((student.id, project.id))) for project in graded_projects)
+    return total / len(graded_projects)
+
+
+def build_gradebook(students, projects):
+    """Build the student x project score matrix.
+
+    Parameters:
+        students (iterable): the students (Person) in the gradebook
+        projects (iterable): the projects in the gradebook
+
+    Returns:
+        [GradebookRow]: one row per student, with the latest submission to
+            each project (or a SubmissionDisplay placeholder) and the grade
+    """
+    students = list(students)
+    projects = list(projects)
+    latest_submissions = get_latest_submissions(students, projects)
+    return [
+        GradebookRow(
+            student,
+            get_submission_displays(student, projects, latest_submissions),
+            get_grade(student, projects, latest_submissions),
+        )
+        for student in students
+    ]
@@ -1,16 +1,98 @@
-from collections import namedtuple
-
-import django_rq
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponseRedirect, Http404, StreamingHttpResponse
+from django.db.models import Avg, Count, F, Max, Q
 from django.shortcuts import render
+from django.utils.text import slugify
 
 from .models import Course, Assignment, Project, Submission, Result
-from .views import get_context, get_last_submission_display
-from .dispatcher import enqueue_assignment_dispatch, enqueue_project_dispatch, enqueue_submission_dispatch, enqueue_submission_evaluation, clear_evaluation_queue
+from .views import get_context
+from .export import get_uploads, stream_grades_csv, stream_grades_json, stream_results_csv, stream_results_json, stream_uploads_zip
+from .pagination import paginate_submissions
+from .gradebook import build_gradebook, get_latest_submissions, get_submission_displays
+from .dispatcher import enqueue_assignment_dispatch, enqueue_project_dispatch, enqueue_submission_dispatch, enqueue_submission_evaluation, enqueue_submission_evaluations, clear_evaluation_queue
+from .scheduler import REGRADE, RECOVERY, count as count_queued
+
+
+def get_evaluation_counts(results):
+    return results.aggregate(
+        num_cached=Count('id', filter=Q(cache_hit=True)),
+        num_executed=Count('id', filter=Q(cache_hit=False, return_code__isnull=False)),
+        num_tbd=Count('id', filter=Q(return_code__isnull=True)),
+    )
+
+
+def get_percentile(values, percentile):
+    """Get a percentile of an ordered queryset of values, or None if it is empty."""
+    num_values = values.count()
+    if num_values == 0:
+        return None
+    return values[int(percentile * (num_values - 1))]
+
+
+def get_runtime_stats(results):
+    """Summarize the resources used by the executed Results.
+
+    Parameters:
+        results (QuerySet): the Results to summarize
+
+    Returns:
+        dict: the number of executed Results, the fraction that timed out,
+            the median and 95th percentile wall time in seconds, the mean CPU
+            time in seconds, and the largest peak memory in MiB
+    """
+    executed = results.filter(cache_hit=False, wall_time__isnull=False)
+    stats = executed.aggregate(
+        num_executed=Count('id'),
+        num_timeouts=Count('id', filter=Q(timed_out=True)),
+        mean_cpu_time=Avg(F('user_time') + F('system_time')),
+        max_rss=Max('max_rss'),
+    )
+    if stats['num_executed']:
+        stats['timeout_rate'] = stats['num_timeouts'] / stats['num_executed']
+    else:
+        stats['timeout_rate'] = 0
+    if stats['max_rss'] is not None:
+        stats['max_rss'] = stats['max_rss'] / 1024
+    wall_times = executed.order_by('wall_time').values_list('wall_time', flat=True)
+    stats['p50_wall_time'] = get_percentile(wall_times, 0.5)
+    stats['p95_wall_time'] = get_percentile(wall_times, 0.95)
+    return stats
 
-AssignmentSummaryRow = namedtuple('AssignmentSummaryRow', ('student', 'submissions', 'grade'))
+
+def get_export_scope(context):
+    """Get what to export for a course, assignment, or project.
+
+    Parameters:
+        context (dict): the result of get_context()
+
+    Returns:
+        [Project]: the projects to include in the grades
+        QuerySet: the Results to include
+        str: the base of the file name
+    """
+    if 'project' in context:
+        projects = [context['project']]
+        results = Result.objects.filter(submission__project=context['project'])
+        name = '{} {} {}'.format(context['course'], context['assignment'].name, context['project'].name)
+    else:
+        if 'assignment' in context:
+            projects = context['assignment'].projects()
+            results = Result.objects.filter(submission__project__assignment=context['assignment'])
+            name = '{} {}'.format(context['course'], context['assignment'].name)
+        else:
+            projects = context['course'].projects()
+            results = Result.objects.filter(submission__project__assignment__course=context['course'])
+            name = str(context['course'])
+        projects = list(projects.filter(visible=True).select_related('assignment'))
+    return projects, results, slugify(name)
+
+
+def get_export_response(chunks, export_format, filename):
+    content_type = {'csv': 'text/csv', 'json': 'application/json', 'zip': 'application/zip'}[export_format]
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(filename, export_format)
+    return response
 
 
 @login_required
@@ -30,7 +112,7 @@ def instructor_submissions_view(request, **kwargs):
     context = get_context(request, **kwargs)
     if not context['user'].is_superuser:
         raise Http404
-    context['queue_size'] = django_rq.get_queue('evaluation').count
+    context['queue_size'] = count_queued()
     context['tbd_size'] = Result.objects.filter(return_code=None).count()
     num_submissions = 100
     context['num_submissions'] = num_submissions
@@ -43,7 +125,7 @@ def instructor_tbd_view(request, **kwargs):
     context = get_context(request, **kwargs)
     if not context['user'].is_superuser:
         raise Http404
-    context['queue_size'] = django_rq.get_queue('evaluation').count
+    context['queue_size'] = count_queued()
     num_tbd_shown = 200
     context['num_tbd_shown'] = num_tbd_shown
     context['tbd_size'] = Result.objects.filter(return_code=None).count()
@@ -56,8 +138,7 @@ def instructor_tbd_regrade_view(request, **kwargs):
     context = get_context(request, **kwargs)
     if not context['user'].is_superuser:
         raise Http404
-    for result in Result.objects.filter(return_code=None):
-        enqueue_submission_evaluation(result.id)
+    enqueue_submission_evaluations(list(Result.objects.filter(return_code=None).values_list('id', flat=True)), priority=RECOVERY)
     return HttpResponseRedirect(reverse('instructor_tbd'))
 
 
@@ -75,27 +156,30 @@ def instructor_student_view(request, **kwargs):
     context = get_context(request, **kwargs)
     if not (context['user'].is_superuser or Course.objects.filter(instructor=context['person']).count()):
         raise Http404
-    context['grades'] = []
-    for course in context['student'].enrolled_courses():
-        if course.instructor != context['person'] and not context['user'].is_superuser:
-            continue
-        for project in course.projects().all():
-            if project.visible:
-                context['grades'].append(get_last_submission_display(context['student'], project))
-    # must write long-form accessors because submission could be SubmissionDisplay
-    context['grades'] = sorted(
-        context['grades'],
-        key=(lambda s: (
-            -s.project.assignment.course.year.value,
-            -s.project.assignment.course.season,
-            s.project.course.catalog_id_str,
-            s.project.assignment.name,
-            s.project.name))
+    projects = Project.objects.filter(
+        assignment__course__enrollment__student=context['student'],
+        visible=True,
+    ).select_related('assignment__course__year', 'assignment__course__department')
+    if not context['user'].is_superuser:
+        projects = projects.filter(assignment__course__instructor=context['person'])
+    projects = sorted(
+        projects,
+        key=(lambda project: (
+            -project.assignment.course.year.value,
+            -project.assignment.course.season,
+            project.assignment.course.catalog_id_str,
+            project.assignment.name,
+            project.name))
     )
-    if context['user'].is_superuser:
-        context['submissions'] = context['student'].submissions()
-    else:
-        context['submissions'] = context['student'].submissions().filter(project__assignment__course__instructor=context['person'])
+    latest_submissions = get_latest_submissions([context['student']], projects)
+    context['grades'] = get_submission_displays(context['student'], projects, latest_submissions)
+    submissions = context['student'].submissions().select_related(
+        'project__assignment__course__year', 'project__assignment__course__department',
+    )
+    if not context['user'].is_superuser:
+        submissions = submissions.filter(project__assignment__course__instructor=context['person'])
+    context['submissions_page'] = paginate_submissions(request, submissions)
+    context['submissions'] = context['submissions_page'].items
     return render(request, 'demograder/instructor/student.html', context)
 
 
@@ -117,22 +201,20 @@ def instructor_assignment_view(request, **kwargs):
     context = get_context(request, **kwargs)
     if not context['is_instructor']:
         raise Http404
-    context['projects'] = context['assignment'].projects().filter(visible=True)
-    context['student_scores'] = []
-    for student in context['course'].enrolled_students():
-        submissions = []
-        for project in context['projects']:
-            if project.submission_type == Project.LATEST:
-                submissions.append(get_last_submission_display(student, project))
-            else:
-                # FIXME deal with other submission types
-                submissions.append(get_last_submission_display(student, project))
-        context['student_scores'].append(AssignmentSummaryRow(
-            student,
-            submissions,
-            '{:.2%}'.format(student.get_assignment_score(context['assignment']))
-        ))
-    context['submissions'] = Submission.objects.filter(project__assignment=context['assignment'])
+    context['projects'] = list(context['assignment'].projects().filter(visible=True))
+    context['student_scores'] = [
+        # FIXME deal with submission types other than Project.LATEST
+        row._replace(grade='{:.2%}'.format(row.grade))
+        for row in build_gradebook(context['course'].enrolled_students(), context['projects'])
+    ]
+    context['evaluations'] = get_evaluation_counts(
+        Result.objects.filter(submission__project__assignment=context['assignment'])
+    )
+    context['submissions_page'] = paginate_submissions(
+        request,
+        Submission.objects.filter(project__assignment=context['assignment']).select_related('student__user', 'project'),
+    )
+    context['submissions'] = context['submissions_page'].items
     return render(request, 'demograder/instructor/assignment.html', context)
 
 
@@ -142,10 +224,17 @@ def instructor_project_view(request, **kwargs):
     if not context['is_instructor']:
         raise Http404
     context['scores'] = [
-        get_last_submission_display(student, context['project'])
-        for student in context['course'].enrolled_students()
+        row.submissions[0]
+        for row in build_gradebook(context['course'].enrolled_students(), [context['project']])
     ]
-    context['submissions'] = Submission.objects.filter(project=context['project'])
+    results = Result.objects.filter(submission__project=context['project'])
+    context['evaluations'] = get_evaluation_counts(results)
+    context['runtime'] = get_runtime_stats(results)
+    context['submissions_page'] = paginate_submissions(
+        request,
+        Submission.objects.filter(project=context['project']).select_related('student__user'),
+    )
+    context['submissions'] = context['submissions_page'].items
     return render(request, 'demograder/instructor/project.html', context)
 
 
@@ -160,12 +249,55 @@ def instructor_submission_view(request, **kwargs):
     return render(request, 'demograder/project.html', context)
 
 
+@login_required
+def instructor_grades_export_view(request, **kwargs):
+    context = get_context(request, **kwargs)
+    if not context['is_instructor']:
+        raise Http404
+    projects, _, filename = get_export_scope(context)
+    students = context['course'].enrolled_students()
+    if kwargs['export_format'] == 'csv':
+        chunks = stream_grades_csv(students, projects)
+    else:
+        chunks = stream_grades_json(students, projects)
+    return get_export_response(chunks, kwargs['export_format'], filename + '-grades')
+
+
+@login_required
+def instructor_results_export_view(request, **kwargs):
+    context = get_context(request, **kwargs)
+    if not context['is_instructor']:
+        raise Http404
+    _, results, filename = get_export_scope(context)
+    if kwargs['export_format'] == 'csv':
+        chunks = stream_results_csv(results)
+    else:
+        chunks = stream_results_json(results)
+    return get_export_response(chunks, kwargs['export_format'], filename + '-results')
+
+
+@login_required
+def instructor_uploads_export_view(request, **kwargs):
+    context = get_context(request, **kwargs)
+    if not context['is_instructor']:
+        raise Http404
+    projects, _, filename = get_export_scope(context)
+    # by default, only the latest submission of each student is included
+    latest_only = (request.GET.get('all') != '1')
+    if not latest_only:
+        filename += '-all'
+    chunks = stream_uploads_zip(get_uploads(projects, latest_only=latest_only), filename, latest_only=latest_only)
+    return get_export_response(chunks, 'zip', filename)
+
+
 @login_required
 def instructor_assignment_regrade_view(request, **kwargs):
     context = get_context(request, **kwargs)
     if not context['is_instructor']:
         raise Http404
-    enqueue_assignment_dispatch(context['assignment'].id)
+    # a regrade is asked for when something the cache cannot see has changed
+    # (eg. the installed compilers), so nothing is taken from the cache
+    enqueue_assignment_dispatch(context['assignment'].id, use_cache=False)
     return HttpResponseRedirect(
         reverse('instructor_assignment', kwargs={'assignment_id': context['project'].assignment.id})
     )
@@ -176,7 +308,7 @@ def instructor_project_regrade_view(request, **kwargs):
     context = get_context(request, **kwargs)
     if not context['is_instructor']:
         raise Http404
-    enqueue_project_dispatch(context['project'].id)
+    enqueue_project_dispatch(context['project'].id, use_cache=False)
     return HttpResponseRedirect(
         reverse('instructor_assignment', kwargs={'assignment_id': context['project'].assignment.id})
     )
@@ -187,7 +319,7 @@ def instructor_submission_regrade_view(request, **kwargs):
     context = get_context(request, **kwargs)
     if not context['is_instructor']:
         raise Http404
-    enqueue_submission_dispatch(context['submission'].id)
+    enqueue_submission_dispatch(context['submission'].id, priority=REGRADE, use_cache=False)
     return HttpResponseRedirect(reverse('submission', kwargs=kwargs))
 
 
@@ -197,5 +329,5 @@ def instructor_result_regrade_view(request, **kwargs):
     if not context['is_instructor']:
         raise Http404
     result = context['result']
-    enqueue_submission_evaluation(result.id)
+    enqueue_submission_evaluation(result.id, priority=REGRADE, use_cache=False)
     return HttpResponseRedirect(reverse('result', kwargs=kwargs))
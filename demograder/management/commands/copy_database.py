@@ -0,0 +1,80 @@
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction
+
+
+@contextmanager
+def keep_timestamps(models):
+    """Stop auto_now and auto_now_add fields from overwriting copied values."""
+    fields = [
+        field
+        for model in models
+        for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = False
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now = auto_now
+            field.auto_now_add = auto_now_add
+
+
+class Command(BaseCommand):
+    help = 'Copy all data from one database to another (eg. from SQLite to PostgreSQL), replacing its contents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default='sqlite', help='the database alias to copy from')
+        parser.add_argument('--target', default='default', help='the (migrated) database alias to copy to')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='number of rows read and written at a time')
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive', help='do not ask for confirmation')
+
+    def handle(self, *args, **options):
+        source = options['source']
+        target = options['target']
+        chunk_size = options['chunk_size']
+        for alias in (source, target):
+            if alias not in connections.databases:
+                raise CommandError('unknown database alias: {}'.format(alias))
+        if source == target:
+            raise CommandError('the source and target databases must be different')
+        if options['interactive']:
+            answer = input('This will erase all data in the "{}" database. Type "yes" to continue: '.format(target))
+            if answer != 'yes':
+                raise CommandError('copy cancelled')
+        models = [
+            model for model in apps.get_models(include_auto_created=True)
+            if model._meta.managed and not model._meta.proxy
+        ]
+        # do not let migrate's post-migrate handlers recreate content types
+        # and permissions, as they are copied with their original IDs
+        call_command('flush', database=target, interactive=False, inhibit_post_migrate=True, verbosity=0)
+        # foreign keys are checked at commit (on PostgreSQL, Django creates
+        # them deferrable), so the tables can be copied in any order
+        with transaction.atomic(using=target), keep_timestamps(models):
+            for model in models:
+                num_rows = 0
+                chunk = []
+                for instance in model._base_manager.using(source).order_by('pk').iterator(chunk_size=chunk_size):
+                    chunk.append(instance)
+                    if len(chunk) == chunk_size:
+                        model._base_manager.using(target).bulk_create(chunk)
+                        num_rows += len(chunk)
+                        chunk = []
+                if chunk:
+                    model._base_manager.using(target).bulk_create(chunk)
+                    num_rows += len(chunk)
+                self.stdout.write('Copied {} {} rows.'.format(num_rows, model._meta.label))
+        # continue the ID sequences after the copied IDs
+        connection = connections[target]
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
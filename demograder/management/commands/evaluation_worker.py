@@ -0,0 +1,198 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from os import cpu_count
+from time import monotonic
+from traceback import format_exc
+
+import django_rq
+from django.core.management.base import BaseCommand, CommandError
+from django.db.utils import OperationalError
+from rq.exceptions import DequeueTimeout
+from rq.registry import StartedJobRegistry
+from rq.utils import utcnow
+from rq.worker import Worker, WorkerStatus
+
+from demograder.dispatcher import evaluate_submission, evaluate_submissions, enqueue_submission_evaluations
+from demograder.dispatcher import plan_evaluations, run_sandbox, store_evaluations
+from demograder.process import parse_cpus
+from demograder.scheduler import PRIORITIES, pump, release
+
+# seconds between heartbeats; the worker, and the jobs it started, are taken
+# to be dead if they miss several in a row
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_TTL = 4 * HEARTBEAT_INTERVAL
+
+
+def _func_name(func):
+    return '{}.{}'.format(func.__module__, func.__name__)
+
+
+class JobState:
+
+    def __init__(self, job, queue, result_ids, use_cache):
+        self.job = job
+        self.queue = queue
+        self.result_ids = result_ids
+        self.use_cache = use_cache
+        self.registry = StartedJobRegistry(job.origin, job.connection)
+        self.evaluations = []
+        self.plans = []
+        self.num_plans = 0
+
+
+class Command(BaseCommand):
+    help = 'Evaluate queued Results, running several sandboxes concurrently in one process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queues', nargs='*', default=list(PRIORITIES), help='the queues to take jobs from, in priority order')
+        parser.add_argument('--concurrency', type=int, default=cpu_count(), help='the maximum number of sandboxes to run at once')
+        parser.add_argument('--cpus', help='CPUs to pin the sandboxes to (eg. "0-15"); each sandbox slot gets one CPU')
+
+    def handle(self, *args, **options):
+        queues = [django_rq.get_queue(name) for name in options['queues']]
+        concurrency = options['concurrency']
+        if concurrency < 1:
+            raise CommandError('concurrency must be at least 1')
+        cpus = None
+        if options['cpus']:
+            cpus = parse_cpus(options['cpus'])
+        # the bookkeeping is done with an RQ worker, so that this process and
+        # its jobs show up like rqworker's, and so that the jobs it was running
+        # when it died are moved to the FailedJobRegistry instead of vanishing
+        self.worker = Worker(queues, connection=queues[0].connection)
+        self.jobs = {}
+        self.last_heartbeat = None
+        self.worker.register_birth()
+        try:
+            self.work(concurrency, cpus)
+        finally:
+            for state in self.jobs.values():
+                self.fail_job(state, 'The evaluation worker stopped before the job finished.\n')
+            self.worker.register_death()
+
+    def work(self, concurrency, cpus):
+        free_slots = list(range(concurrency))
+        pending_plans = deque()
+        running = {}
+        # only this thread touches the database; the pool threads only manage
+        # sandbox files and wait on the sandboxed processes
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                while free_slots:
+                    if not pending_plans:
+                        job_and_queue = self.dequeue(block=(not running))
+                        if job_and_queue is None:
+                            break
+                        state = self.plan_job(*job_and_queue)
+                        if state is None:
+                            continue
+                        if state.num_plans == 0:
+                            self.finish_job(state)
+                            continue
+                        self.jobs[state.job.id] = state
+                        pending_plans.extend((state.job.id, plan) for plan in state.plans)
+                        continue
+                    job_id, plan = pending_plans.popleft()
+                    slot = free_slots.pop()
+                    slot_cpus = None
+                    if cpus:
+                        slot_cpus = str(cpus[slot % len(cpus)])
+                    running[executor.submit(run_sandbox, plan, slot_cpus)] = (job_id, slot)
+                if not running:
+                    continue
+                done, _ = wait(running, timeout=HEARTBEAT_INTERVAL, return_when=FIRST_COMPLETED)
+                self.heartbeat()
+                for future in done:
+                    job_id, slot = running.pop(future)
+                    free_slots.append(slot)
+                    state = self.jobs[job_id]
+                    try:
+                        state.evaluations.extend(future.result())
+                    except Exception: # pylint: disable=broad-except
+                        # the Results of this sandbox stay TBD
+                        self.stderr.write(format_exc())
+                    state.num_plans -= 1
+                    if state.num_plans == 0:
+                        self.finish_job(self.jobs.pop(job_id))
+
+    def heartbeat(self):
+        """Keep the worker, and the jobs it started, from being taken to be dead."""
+        if self.last_heartbeat is not None and monotonic() - self.last_heartbeat < HEARTBEAT_INTERVAL:
+            return
+        self.last_heartbeat = monotonic()
+        with self.worker.connection.pipeline() as pipeline:
+            self.worker.heartbeat(HEARTBEAT_TTL, pipeline=pipeline)
+            for state in self.jobs.values():
+                state.registry.add(state.job, HEARTBEAT_TTL, pipeline=pipeline)
+            pipeline.execute()
+
+    def dequeue(self, block):
+        if self.worker.should_run_maintenance_tasks:
+            # like rqworker, move the jobs of dead workers to the FailedJobRegistry
+            self.worker.clean_registries()
+        if block:
+            self.worker.set_state(WorkerStatus.IDLE)
+        self.heartbeat()
+        try:
+            job_and_queue = self.worker.queue_class.dequeue_any(
+                self.worker.queues,
+                (5 if block else None),
+                connection=self.worker.connection,
+                job_class=self.worker.job_class,
+            )
+        except DequeueTimeout:
+            # nothing is queued; make sure no jobs are left waiting
+            pump()
+            return None
+        return job_and_queue
+
+    def plan_job(self, job, queue):
+        if job.func_name == _func_name(evaluate_submission):
+            result_ids = [job.args[0]]
+        elif job.func_name == _func_name(evaluate_submissions):
+            result_ids = list(job.args[0])
+        else:
+            # not an evaluation; run it the way rqworker would
+            self.worker.perform_job(job, queue, heartbeat_ttl=HEARTBEAT_TTL)
+            return None
+        # jobs enqueued by older versions only have the first argument
+        use_cache = job.args[1] if len(job.args) > 1 else True
+        # mark the job as started, in the StartedJobRegistry of its queue
+        self.worker.prepare_job_execution(job, heartbeat_ttl=HEARTBEAT_TTL)
+        job.started_at = utcnow()
+        state = JobState(job, queue, result_ids, use_cache)
+        release('evaluate', result_ids)
+        try:
+            state.evaluations, state.plans = plan_evaluations(result_ids, use_cache=use_cache)
+        except OperationalError:
+            enqueue_submission_evaluations(result_ids, priority=job.origin, use_cache=use_cache)
+            self.succeed_job(state)
+            return None
+        except Exception: # pylint: disable=broad-except
+            # eg. a missing upload or grading script
+            self.fail_job(state, format_exc())
+            return None
+        state.num_plans = len(state.plans)
+        return state
+
+    def finish_job(self, state):
+        try:
+            store_evaluations(state.evaluations)
+        except OperationalError:
+            enqueue_submission_evaluations(state.result_ids, priority=state.job.origin, use_cache=state.use_cache)
+            self.succeed_job(state)
+        except Exception: # pylint: disable=broad-except
+            self.fail_job(state, format_exc())
+        else:
+            self.succeed_job(state)
+        pump()
+
+    def succeed_job(self, state):
+        state.job.ended_at = utcnow()
+        self.worker.handle_job_success(state.job, state.queue, state.registry)
+
+    def fail_job(self, state, exc_string):
+        """Log an error and keep the job as failed, like rqworker."""
+        self.stderr.write(exc_string)
+        state.job.ended_at = utcnow()
+        self.worker.handle_job_failure(state.job, started_job_registry=state.registry, exc_string=exc_string)
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from demograder.models import CachedEvaluation
+
+
+class Command(BaseCommand):
+    help = 'Delete cached evaluations that have not been saved recently'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help='delete evaluations last saved more than this many days ago')
+        parser.add_argument('--all', action='store_true', help='delete every cached evaluation')
+
+    def handle(self, *args, **options):
+        cached_evaluations = CachedEvaluation.objects.all()
+        if not options['all']:
+            if options['days'] < 0:
+                raise CommandError('days must not be negative')
+            cached_evaluations = cached_evaluations.filter(
+                timestamp__lt=(timezone.now() - timedelta(days=options['days'])),
+            )
+        num_deleted, _ = cached_evaluations.delete()
+        self.stdout.write('Deleted {} cached evaluations.'.format(num_deleted))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from demograder.models import Submission, LatestSubmission
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the (student, project) to latest Submission index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='number of rows inserted per query')
+
+    def handle(self, *args, **options):
+        latest_submissions = []
+        last_key = None
+        submissions = Submission.objects.order_by('student', 'project', '-timestamp', '-id')
+        for submission_id, student_id, project_id in submissions.values_list('id', 'student', 'project').iterator():
+            if (student_id, project_id) == last_key:
+                continue
+            last_key = (student_id, project_id)
+            latest_submissions.append(LatestSubmission(
+                student_id=student_id,
+                project_id=project_id,
+                submission_id=submission_id,
+            ))
+        with transaction.atomic():
+            LatestSubmission.objects.all().delete()
+            LatestSubmission.objects.bulk_create(latest_submissions, batch_size=options['batch_size'])
+        self.stdout.write('Indexed {} latest submissions.'.format(len(latest_submissions)))
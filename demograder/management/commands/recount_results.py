@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from demograder.models import Submission, Result, RESULT_COUNTS
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized passed/failed/TBD counts on every Submission'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='number of submissions updated per transaction')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        submission_ids = list(Submission.objects.order_by('id').values_list('id', flat=True))
+        num_changed = 0
+        for start in range(0, len(submission_ids), chunk_size):
+            chunk = submission_ids[start:start + chunk_size]
+            counts = {
+                row['submission']: row
+                for row in Result.objects.filter(submission__in=chunk).values('submission').annotate(**RESULT_COUNTS)
+            }
+            with transaction.atomic():
+                submissions = []
+                for submission in Submission.objects.filter(id__in=chunk).only('id', *RESULT_COUNTS):
+                    row = counts.get(submission.id, {})
+                    changed = False
+                    for field in RESULT_COUNTS:
+                        value = row.get(field, 0)
+                        if getattr(submission, field) != value:
+                            setattr(submission, field, value)
+                            changed = True
+                    if changed:
+                        submissions.append(submission)
+                Submission.objects.bulk_update(submissions, list(RESULT_COUNTS))
+            num_changed += len(submissions)
+        self.stdout.write('Recounted {} submissions ({} changed).'.format(len(submission_ids), num_changed))
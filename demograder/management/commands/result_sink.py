@@ -0,0 +1,57 @@
+from time import sleep
+from traceback import format_exc
+
+from django.core.management.base import BaseCommand
+from django.db.utils import OperationalError
+
+from demograder.dispatcher import RESULT_SINK_DEAD_KEY, RESULT_SINK_KEY
+from demograder.dispatcher import deserialize_evaluations, get_connection, save_evaluations_with_retry
+
+
+class Command(BaseCommand):
+    help = 'Write the evaluation results sent by workers to the database through a single connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='maximum number of results written per transaction')
+        parser.add_argument('--interval', type=float, default=0.5, help='seconds to wait when there are no results')
+        parser.add_argument('--attempts', type=int, default=5, help='number of times to try a batch before saving its results one at a time')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        connection = get_connection()
+        num_failures = 0
+        while True:
+            data = connection.lrange(RESULT_SINK_KEY, 0, batch_size - 1)
+            if not data:
+                sleep(options['interval'])
+                continue
+            try:
+                save_evaluations_with_retry(deserialize_evaluations(data))
+            except OperationalError as error:
+                num_failures += 1
+                self.stderr.write('Failed to save results: {}'.format(error))
+                if num_failures < options['attempts']:
+                    # keep the batch and try again
+                    continue
+                self.save_individually(connection, data)
+            except Exception: # pylint: disable=broad-except
+                self.stderr.write(format_exc())
+                self.save_individually(connection, data)
+            num_failures = 0
+            # only remove the results once they are saved (or set aside); this
+            # is safe because there is only one sink, and workers only append
+            # to the list
+            connection.ltrim(RESULT_SINK_KEY, len(data), -1)
+
+    def save_individually(self, connection, data):
+        """Save results one at a time, so that one bad result does not block the rest.
+
+        Results that still cannot be saved are moved to RESULT_SINK_DEAD_KEY,
+        and are left TBD.
+        """
+        for datum in data:
+            try:
+                save_evaluations_with_retry(deserialize_evaluations([datum]))
+            except Exception: # pylint: disable=broad-except
+                self.stderr.write(format_exc())
+                connection.rpush(RESULT_SINK_DEAD_KEY, datum)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from demograder.filestore import restrict_store, store_upload
+from demograder.models import Upload
+
+
+class Command(BaseCommand):
+    help = 'Move existing uploads into the content-addressed store, deduplicating identical files'
+
+    def handle(self, *args, **options):
+        restrict_store()
+        digests = set()
+        num_uploads = 0
+        for upload in Upload.objects.filter(digest='').iterator():
+            store_upload(upload)
+            digests.add(upload.digest)
+            num_uploads += 1
+        self.stdout.write('Stored {} uploads ({} distinct files).'.format(num_uploads, len(digests)))
@@ -1,14 +1,30 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 from os.path import basename, dirname, join as join_path
 
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, Q
 from django.db.models.functions import Lower
-from pytz import timezone, UTC
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from pytz import timezone
+
+from .throttle import get_submission_wait, take_submission_token
 
 UPLOAD_PATH = 'uploads'
 
 
+@receiver(connection_created)
+def _configure_sqlite(sender, connection, **kwargs):
+    # with a write-ahead log, readers (eg. the web server) do not block the
+    # workers' writes and vice versa; the busy timeout is set in settings.py
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+
+
 class Person(models.Model):
 
     class Meta:
@@ -46,19 +62,6 @@ class Person(models.Model):
             '-year__value', '-season', 'department__catalog_code', 'course_number'
         )
 
-    def get_assignment_score(self, assignment):
-        total = 0
-        num_projects = 0
-        for project in Project.objects.filter(assignment=assignment, visible=True):
-            num_projects += 1
-            submission = self.latest_submission(project)
-            if submission and submission.max_score > 0:
-                total += submission.score / submission.max_score
-        if num_projects == 0:
-            return 0
-        else:
-            return total / num_projects
-
     def submissions(self, project=None):
         if project:
             return Submission.objects.filter(student=self, project=project)
@@ -66,30 +69,29 @@ class Person(models.Model):
             return Submission.objects.filter(student=self)
 
     def latest_submission(self, project=None):
-        submissions = self.submissions(project=project)
-        if submissions:
-            return submissions.latest()
-        else:
-            return None
+        latest_submissions = Submission.objects.filter(latestsubmission__student=self)
+        if project:
+            latest_submissions = latest_submissions.filter(latestsubmission__project=project)
+        return latest_submissions.first()
 
-    def may_submit(self, project):
+    def may_submit(self, project, take=False):
         """Determines if the student is allowed to submit to a project
 
         The motivation behind stopping student submissions is to prevent
         overloading the system, and (in theory) to instill a more thorough
-        manual debugging process. There are three trivial cases when a user can
-        submit:
-
-        * they are a superuser
-        * they are the instructor for the course
-        * they have not submitted to this project before
-
-        If they are not the instructor and have previous submissions, then all
-        of the following must be true for the student to submit:
+        manual debugging process. Superusers and the instructor of the course
+        can always submit. Otherwise, all of the following must be true for the
+        student to submit:
 
         * the project is not locked
-        * all their previous submissions for this project have finished running
-        * 300 seconds has passed since their last submission to this project
+        * their latest submission for this project (if any) has finished running
+        * they have a submission left in their token bucket for this project
+          (see demograder/throttle.py)
+
+        The bucket holds up to the project's submission_burst submissions, and
+        one is added back every submission_interval seconds, so a student who
+        has not submitted to the project before (or not recently) starts with
+        a full bucket. Every submission takes one, including the first.
 
         This function returns different string constants to reflect which of the
         above three conditions have been violated, so that an appropriate error
@@ -97,30 +99,47 @@ class Person(models.Model):
 
         Parameters:
             project (Project): the project to determine submission status for
+            take (bool): if the student may submit, also take a submission from
+                their bucket; this is atomic, so that concurrent requests
+                cannot both succeed. Otherwise, the bucket is only checked.
 
         Returns:
             string: one of three string constants
                 'yes': the student may submit
                 'locked': the project is locked
                 'submission': the student is blocked by their last submission
-                'timeout': it has been less than 300 seconds since their last
-                           submission to this project
+                'timeout': the student has submitted to this project too
+                           recently
+        """
+        return self.get_submission_status(project, take=take)[0]
+
+    def get_submission_status(self, project, take=False):
+        """Determine if the student may submit, and how long they need to wait.
+
+        Parameters:
+            project (Project): the project to determine submission status for
+            take (bool): as for may_submit()
+
+        Returns:
+            string: as for may_submit()
+            float: the number of seconds until the student may submit, if the
+                status is 'timeout'; otherwise 0
         """
-        if self.user.is_superuser or project.course.instructor == self:
-            return 'yes'
+        if self.user.is_superuser or project.course.instructor_id == self.id:
+            return 'yes', 0
         if project.locked:
-            return 'locked'
+            return 'locked', 0
         last_submission = self.latest_submission(project)
-        if not last_submission:
-            return 'yes'
-        if last_submission.num_tbd != 0:
-            return 'submission'
-        current_time = UTC.normalize(datetime.now(last_submission.timestamp.tzinfo))
-        submit_time = UTC.normalize(last_submission.timestamp)
-        if current_time - submit_time < timedelta(seconds=300):
-            return 'timeout'
+        if last_submission and last_submission.num_tbd != 0:
+            return 'submission', 0
+        if take:
+            wait = take_submission_token(self.id, project)
+        else:
+            wait = get_submission_wait(self.id, project)
+        if wait == 0:
+            return 'yes', 0
         else:
-            return 'yes'
+            return 'timeout', wait
 
     def __str__(self):
         # human readable, used by Django admin displays
@@ -192,7 +211,7 @@ class Course(models.Model):
         return '{} {}'.format(self.department.catalog_code, self.course_number)
 
     def enrolled_students(self):
-        return Person.objects.filter(enrollment__course=self).order_by(Lower('user__last_name'))
+        return Person.objects.filter(enrollment__course=self).select_related('user').order_by(Lower('user__last_name'))
 
     def assignments(self):
         return Assignment.objects.filter(course=self)
@@ -200,6 +219,23 @@ class Course(models.Model):
     def projects(self):
         return Project.objects.filter(assignment__course=self)
 
+    def latest_submissions(self, students=None):
+        """Get the latest submission of every student to every project.
+
+        Parameters:
+            students (iterable): only include these students (default: all)
+
+        Returns:
+            dict: from (student ID, project ID) to Submission
+        """
+        latest_submissions = Submission.objects.filter(latestsubmission__project__assignment__course=self)
+        if students is not None:
+            latest_submissions = latest_submissions.filter(latestsubmission__student__in=students)
+        return {
+            (submission.student_id, submission.project_id): submission
+            for submission in latest_submissions
+        }
+
     def __str__(self):
         # human readable, used by Django admin displays
         return self.semester_str + ' ' + self.catalog_id_str
@@ -299,6 +335,17 @@ class Project(models.Model):
     script = models.FileField(upload_to=_project_path, blank=True, max_length=500)
     visible = models.BooleanField(default=False)
     locked = models.BooleanField(default=False)
+    # reuse the output of previous evaluations with identical inputs
+    cache_results = models.BooleanField(default=True)
+    # students may submit up to submission_burst times in a row, and then once
+    # every submission_interval seconds; an interval of 0 disables the limit
+    submission_interval = models.IntegerField(default=300)
+    submission_burst = models.IntegerField(default=1)
+    # resource limits of each test, enforced with cgroups if CGROUP_ROOT is
+    # set; empty for no limit
+    memory_limit = models.IntegerField(null=True, blank=True, help_text='in MiB')
+    cpu_limit = models.FloatField(null=True, blank=True, help_text='in number of CPUs')
+    pids_limit = models.IntegerField(null=True, blank=True, help_text='maximum number of processes and threads')
 
     @property
     def course(self):
@@ -342,6 +389,20 @@ class Project(models.Model):
     def downstream_dependencies(self):
         return ProjectDependency.objects.filter(producer=self)
 
+    def latest_submissions(self, students=None):
+        """Get the latest submission of every student to this project.
+
+        Parameters:
+            students (iterable): only include these students (default: all)
+
+        Returns:
+            dict: from student ID to Submission
+        """
+        latest_submissions = Submission.objects.filter(latestsubmission__project=self)
+        if students is not None:
+            latest_submissions = latest_submissions.filter(latestsubmission__student__in=students)
+        return {submission.student_id: submission for submission in latest_submissions}
+
     def __str__(self):
         # human readable, used by Django admin displays
         return '{}: {}'.format(self.assignment, self.name)
@@ -393,10 +454,20 @@ class Submission(models.Model):
     class Meta:
         get_latest_by = 'timestamp'
         ordering = ('-timestamp',)
+        indexes = (
+            # a student's submissions to a project, newest first
+            models.Index(fields=('student', 'project', '-timestamp'), name='submission_student_project'),
+            # all submissions to a project, newest first
+            models.Index(fields=('project', '-timestamp'), name='submission_project_timestamp'),
+        )
 
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     student = models.ForeignKey(Person, on_delete=models.CASCADE)
     timestamp = models.DateTimeField(auto_now_add=True)
+    # denormalized Result counts, maintained by the dispatcher
+    num_passed = models.IntegerField(default=0)
+    num_failed = models.IntegerField(default=0)
+    num_tbd = models.IntegerField(default=0)
 
     @property
     def course(self):
@@ -415,18 +486,6 @@ class Submission(models.Model):
             datetime.today().strftime('%Y%m%d%H%M%S%f'),
         )
 
-    @property
-    def num_passed(self):
-        return len(self.result_set.filter(return_code=0))
-
-    @property
-    def num_failed(self):
-        return len(self.result_set.exclude(return_code=0).exclude(return_code__isnull=True))
-
-    @property
-    def num_tbd(self):
-        return len(self.result_set.filter(return_code__isnull=True))
-
     @property
     def score(self):
         return self.num_passed
@@ -454,6 +513,67 @@ class Submission(models.Model):
     def uploads(self):
         return Upload.objects.filter(submission=self)
 
+    def save(self, *args, **kwargs):
+        is_new = self.pk is None
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if is_new:
+                LatestSubmission.objects.update_or_create(
+                    student=self.student,
+                    project=self.project,
+                    defaults={'submission': self},
+                )
+
+    def count_results(self):
+        return self.result_set.aggregate(**RESULT_COUNTS)
+
+    def recount_results(self):
+        """Recompute the denormalized Result counts from the Result table.
+
+        This is only necessary if Results were modified outside of the
+        dispatcher (eg. through the Django admin), or for data that predates
+        the counts.
+        """
+        counts = self.count_results()
+        Submission.objects.filter(pk=self.pk).update(**counts)
+        for field, value in counts.items():
+            setattr(self, field, value)
+
+
+class LatestSubmission(models.Model):
+    """Index from (student, project) to the latest Submission.
+
+    Maintained by Submission.save() and by the post_delete handler below, so
+    that the latest submissions for a whole project or course can be fetched
+    in a single query.
+    """
+
+    class Meta:
+        unique_together = ('student', 'project')
+        verbose_name_plural = 'LatestSubmissions'
+
+    student = models.ForeignKey(Person, on_delete=models.CASCADE)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    submission = models.OneToOneField(Submission, on_delete=models.CASCADE)
+
+
+@receiver(post_delete, sender=Submission)
+def _repoint_latest_submission(sender, instance, **kwargs):
+    # the LatestSubmission that pointed to the deleted submission (if any) has
+    # already been removed by the cascade; point it at the next latest one
+    if LatestSubmission.objects.filter(student_id=instance.student_id, project_id=instance.project_id).exists():
+        return
+    submission = Submission.objects.filter(
+        student_id=instance.student_id,
+        project_id=instance.project_id,
+    ).order_by('-timestamp').first()
+    if submission:
+        LatestSubmission.objects.create(
+            student_id=submission.student_id,
+            project_id=submission.project_id,
+            submission=submission,
+        )
+
 
 def _upload_path(instance, filename):
     return join_path(instance.submission.directory, filename)
@@ -463,6 +583,8 @@ class Upload(models.Model):
     submission = models.ForeignKey(Submission, on_delete=models.CASCADE)
     project_file = models.ForeignKey(ProjectFile, on_delete=models.CASCADE)
     file = models.FileField(upload_to=_upload_path, max_length=500)
+    # SHA-256 of the contents, set once the file is in the content-addressed store
+    digest = models.CharField(max_length=64, blank=True, db_index=True)
 
     @property
     def dirname(self):
@@ -493,12 +615,49 @@ class Upload(models.Model):
         return self.submission.student
 
 
+RESULT_COUNTS = {
+    'num_passed': Count('id', filter=Q(return_code=0)),
+    'num_failed': Count('id', filter=Q(return_code__isnull=False) & ~Q(return_code=0)),
+    'num_tbd': Count('id', filter=Q(return_code__isnull=True)),
+}
+
+
+def _result_count_field(return_code):
+    if return_code is None:
+        return 'num_tbd'
+    elif return_code == 0:
+        return 'num_passed'
+    else:
+        return 'num_failed'
+
+
 class Result(models.Model):
+
+    class Meta:
+        indexes = (
+            # the Results of a submission, by outcome
+            models.Index(fields=('submission', 'return_code'), name='result_submission_return_code'),
+            # TBD Results are few, but are looked for across the whole table
+            models.Index(fields=('id',), name='result_tbd', condition=Q(return_code__isnull=True)),
+        )
+
     submission = models.ForeignKey(Submission, on_delete=models.CASCADE)
     timestamp = models.DateTimeField(auto_now_add=True)
     stdout = models.TextField(blank=True)
     stderr = models.TextField(blank=True)
     return_code = models.IntegerField(null=True, blank=True)
+    cache_hit = models.BooleanField(default=False)
+    # whether it was killed for exceeding the timeout; a program killed by the
+    # memory limit has the same return code
+    timed_out = models.BooleanField(default=False)
+    # resources used by the sandboxed process tree; empty if it was not run
+    wall_time = models.FloatField(null=True, blank=True)
+    user_time = models.FloatField(null=True, blank=True)
+    system_time = models.FloatField(null=True, blank=True)
+    max_rss = models.IntegerField(null=True, blank=True, help_text='peak memory in KiB')
+    # the full size of the output, of which only the beginning and end are kept
+    stdout_size = models.IntegerField(null=True, blank=True)
+    stderr_size = models.IntegerField(null=True, blank=True)
 
     @property
     def course(self):
@@ -544,6 +703,79 @@ class Result(models.Model):
     def failed(self):
         return not self.passed
 
+    def record(self, stdout, stderr, return_code, cache_hit=False, usage=None, output_sizes=None, timed_out=False):
+        """Save the output of an evaluation and update the Submission counts.
+
+        The previous return code is re-read inside the transaction with the row
+        locked, so that concurrent evaluations of the same Result cannot double
+        count. (SQLite locks the whole database for writes instead.)
+
+        Parameters:
+            stdout (str): the standard output of the evaluation
+            stderr (str): the standard error of the evaluation
+            return_code (int): the return code of the evaluation
+            cache_hit (bool): whether the output was reused from a previous
+                evaluation with the same inputs
+            usage (Usage): the resources used by the evaluation, if it was run
+            output_sizes ((int, int)): the sizes of the standard output and
+                error in bytes, if it was run
+            timed_out (bool): whether it was killed for exceeding the timeout
+        """
+        resources = {
+            'wall_time': None,
+            'user_time': None,
+            'system_time': None,
+            'max_rss': None,
+        }
+        if usage:
+            resources = usage._asdict()
+        resources['stdout_size'], resources['stderr_size'] = output_sizes or (None, None)
+        with transaction.atomic():
+            old_return_codes = list(
+                Result.objects.select_for_update().filter(pk=self.pk).values_list('return_code', flat=True)
+            )
+            if not old_return_codes:
+                # the Result was deleted (eg. by a regrade) while being evaluated
+                return
+            old_return_code = old_return_codes[0]
+            Result.objects.filter(pk=self.pk).update(
+                stdout=stdout,
+                stderr=stderr,
+                return_code=return_code,
+                cache_hit=cache_hit,
+                timed_out=timed_out,
+                **resources,
+            )
+            old_field = _result_count_field(old_return_code)
+            new_field = _result_count_field(return_code)
+            if old_field != new_field:
+                Submission.objects.filter(pk=self.submission_id).update(**{
+                    old_field: F(old_field) - 1,
+                    new_field: F(new_field) + 1,
+                })
+        self.stdout = stdout
+        self.stderr = stderr
+        self.return_code = return_code
+        self.cache_hit = cache_hit
+        self.timed_out = timed_out
+        for field, value in resources.items():
+            setattr(self, field, value)
+
+
+class CachedEvaluation(models.Model):
+    """The output of an evaluation, keyed by a digest of all its inputs.
+
+    The inputs are the grading script, dglib, the timeout, the resource limits
+    that are enforced, and the name and contents of every file in the sandbox.
+    Instructor regrades always run again and replace the cached output. Old
+    entries are deleted with `./manage.py prune_evaluation_cache`.
+    """
+    digest = models.CharField(max_length=64, unique=True)
+    timestamp = models.DateTimeField(auto_now=True)
+    stdout = models.TextField(blank=True)
+    stderr = models.TextField(blank=True)
+    return_code = models.IntegerField()
+
 
 class StudentDependency(models.Model):
 
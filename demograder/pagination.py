@@ -0,0 +1,65 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from collections import namedtuple
+
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+
+PAGE_SIZE = 50
+
+Page = namedtuple('Page', 'items, cursor, next_cursor')
+
+
+def encode_cursor(submission):
+    key = '{}|{}'.format(submission.timestamp.isoformat(), submission.id)
+    return urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, submission_id = urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        timestamp = parse_datetime(timestamp)
+        submission_id = int(submission_id)
+    except (Base64Error, UnicodeError, ValueError):
+        raise Http404
+    if timestamp is None:
+        raise Http404
+    return timestamp, submission_id
+
+
+def paginate_submissions(request, submissions, page_size=PAGE_SIZE):
+    """Get one page of submissions, newest first.
+
+    Pages are found by the (timestamp, id) of the last submission on the
+    previous page, instead of by an offset, so that every page is an index
+    range scan no matter how far back it is, and so that new submissions do
+    not shift the pages. The cursor is taken from the "before" query parameter.
+
+    Parameters:
+        request (HttpRequest): the request for the page
+        submissions (QuerySet): the Submissions to paginate
+        page_size (int): the maximum number of submissions on a page
+
+    Returns:
+        Page: the submissions on the page, the cursor of the page (None for
+            the first page), and the cursor of the next page (None for the
+            last page)
+
+    Raises:
+        Http404: if the cursor is malformed
+    """
+    cursor = request.GET.get('before')
+    submissions = submissions.order_by('-timestamp', '-id')
+    if cursor:
+        timestamp, submission_id = decode_cursor(cursor)
+        submissions = submissions.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=submission_id)
+        )
+    items = list(submissions[:page_size + 1])
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor(items[-1])
+    else:
+        next_cursor = None
+    return Page(items, cursor, next_cursor)
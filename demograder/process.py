@@ -0,0 +1,162 @@
+from collections import namedtuple
+from os import read, wait4, WEXITSTATUS, WIFSIGNALED, WNOHANG, WTERMSIG
+from selectors import DefaultSelector, EVENT_READ
+from signal import SIGPIPE
+from time import monotonic
+
+# this module is shared by the dispatcher and the zygote, so it must not
+# depend on Django
+
+CHUNK_SIZE = 2**16
+
+# the return code of a process that was stopped for printing too much, as if
+# it had been killed by writing to a closed pipe
+OUTPUT_LIMIT_RETURN_CODE = -SIGPIPE
+
+# times are in seconds; peak memory is in KiB
+Usage = namedtuple('Usage', ('wall_time', 'user_time', 'system_time', 'max_rss'))
+
+
+class BoundedBuffer:
+    """Keep the beginning and end of a stream, and count its length.
+
+    Parameters:
+        head_size (int): the number of bytes to keep from the beginning, or
+            None to keep everything
+        tail_size (int): the number of bytes to keep from the end
+    """
+
+    def __init__(self, head_size=None, tail_size=0):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.size = 0
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.head_size is None:
+            self.head.extend(chunk)
+            return
+        room = self.head_size - len(self.head)
+        if room > 0:
+            self.head.extend(chunk[:room])
+            chunk = chunk[room:]
+        if chunk and self.tail_size:
+            self.tail.extend(chunk)
+            # trim occasionally instead of on every write
+            if len(self.tail) > 2 * self.tail_size:
+                del self.tail[:-self.tail_size]
+
+    def getvalue(self):
+        """Get the kept output, marking where any bytes were left out."""
+        tail = b''
+        if self.tail_size:
+            tail = bytes(self.tail[-self.tail_size:])
+        omitted = self.size - len(self.head) - len(tail)
+        if omitted == 0:
+            return bytes(self.head) + tail
+        marker = '\n\n[{} bytes omitted]\n\n'.format(omitted).encode('utf-8')
+        return bytes(self.head) + marker + tail
+
+
+def collect_output(fds, timeout=None, head_size=None, tail_size=0, max_size=None):
+    """Read from some file descriptors until they are closed.
+
+    Only the beginning and end of each stream is kept in memory, so that a
+    program that prints without end does not exhaust the memory of the worker.
+
+    Parameters:
+        fds ([int]): the file descriptors to read from
+        timeout (float): if given, the number of seconds to stop reading after
+        head_size (int): the number of bytes to keep from the beginning of
+            each stream, or None to keep everything
+        tail_size (int): the number of bytes to keep from the end of each
+            stream
+        max_size (int): if given, the number of bytes (over all streams) to
+            stop reading after
+
+    Returns:
+        dict: from file descriptor to BoundedBuffer
+        bool: whether the reading timed out
+        bool: whether the reading stopped because there was too much output
+    """
+    buffers = {fd: BoundedBuffer(head_size, tail_size) for fd in fds}
+    total_size = 0
+    deadline = None
+    if timeout is not None:
+        deadline = monotonic() + timeout
+    with DefaultSelector() as selector:
+        for fd in fds:
+            selector.register(fd, EVENT_READ)
+        while selector.get_map():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return buffers, True, False
+            for key, _ in selector.select(remaining):
+                chunk = read(key.fd, CHUNK_SIZE)
+                if chunk:
+                    buffers[key.fd].write(chunk)
+                    total_size += len(chunk)
+                    if max_size is not None and total_size > max_size:
+                        return buffers, False, True
+                else:
+                    selector.unregister(key.fd)
+    return buffers, False, False
+
+
+def parse_cpus(cpus):
+    """Parse a CPU list in the format accepted by `taskset -c` (eg. "0-3,8")."""
+    result = []
+    for part in cpus.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            result.extend(range(int(first), int(last) + 1))
+        else:
+            result.append(int(part))
+    return result
+
+
+def _get_status(status, rusage, start_time):
+    wall_time = monotonic() - start_time
+    if WIFSIGNALED(status):
+        return_code = -WTERMSIG(status)
+    else:
+        return_code = WEXITSTATUS(status)
+    return return_code, Usage(wall_time, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+
+
+def poll_process(pid, start_time):
+    """Check whether a child process has finished, without waiting for it.
+
+    Parameters:
+        pid (int): the process ID of the child
+        start_time (float): the value of time.monotonic() when it started
+
+    Returns:
+        (int, Usage): as for wait_process(), or None if it is still running
+    """
+    waited_pid, status, rusage = wait4(pid, WNOHANG)
+    if waited_pid == 0:
+        return None
+    return _get_status(status, rusage, start_time)
+
+
+def wait_process(pid, start_time):
+    """Wait for a child process and measure the resources it used.
+
+    The CPU time and peak memory include all descendants that the process
+    waited for, which covers the whole process tree for sudo and timeout.
+
+    Parameters:
+        pid (int): the process ID of the child
+        start_time (float): the value of time.monotonic() when it started
+
+    Returns:
+        int: the return code, negative if the process was killed by a signal
+        Usage: the resources used by the process
+    """
+    _, status, rusage = wait4(pid, 0)
+    return _get_status(status, rusage, start_time)
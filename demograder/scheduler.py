@@ -0,0 +1,477 @@
+from collections import defaultdict
+from time import time
+
+import django_rq
+from django.conf import settings
+from rq.exceptions import NoSuchJobError
+from rq.job import JobStatus
+
+# priority classes, from highest to lowest; each is also the name of the RQ
+# queue that workers take its jobs from
+INTERACTIVE = 'evaluation'
+REGRADE = 'regrade'
+RECOVERY = 'recovery'
+PRIORITIES = (INTERACTIVE, REGRADE, RECOVERY)
+
+KEY_PREFIX = 'demograder:scheduler'
+
+# Jobs wait in per-student flows until they are moved into the RQ queue of
+# their priority class. Each class has a ring of courses with waiting jobs,
+# each course has a ring of students with waiting jobs, and each student has
+# a list of job IDs. A course is in the ring iff it has a student with waiting
+# jobs, and a student is in the ring iff they have waiting jobs.
+
+PUSH_SCRIPT = '''
+local course_ring = ARGV[1]
+local student_ring = course_ring .. ':' .. ARGV[2]
+local flow = student_ring .. ':' .. ARGV[3]
+local was_empty = (redis.call('LLEN', flow) == 0)
+for i = 4, #ARGV do
+    redis.call('RPUSH', flow, ARGV[i])
+end
+redis.call('INCRBY', course_ring .. ':size', #ARGV - 3)
+if was_empty then
+    if redis.call('LLEN', student_ring) == 0 then
+        redis.call('RPUSH', course_ring, ARGV[2])
+    end
+    redis.call('RPUSH', student_ring, ARGV[3])
+end
+'''
+
+POP_SCRIPT = '''
+local course_ring = ARGV[1]
+local course = redis.call('LPOP', course_ring)
+if not course then
+    return false
+end
+local student_ring = course_ring .. ':' .. course
+local student = redis.call('LPOP', student_ring)
+local flow = student_ring .. ':' .. student
+local job_id = redis.call('LPOP', flow)
+redis.call('DECR', course_ring .. ':size')
+if redis.call('LLEN', flow) > 0 then
+    redis.call('RPUSH', student_ring, student)
+end
+if redis.call('LLEN', student_ring) > 0 then
+    redis.call('RPUSH', course_ring, course)
+end
+return job_id
+'''
+
+CANCEL_SCRIPT = '''
+local course_ring = ARGV[1]
+local student_ring = course_ring .. ':' .. ARGV[2]
+local flow = student_ring .. ':' .. ARGV[3]
+local removed = 0
+for i = 4, #ARGV do
+    removed = removed + redis.call('LREM', flow, 1, ARGV[i])
+end
+redis.call('DECRBY', course_ring .. ':size', removed)
+if removed > 0 and redis.call('LLEN', flow) == 0 then
+    redis.call('LREM', student_ring, 1, ARGV[3])
+    if redis.call('LLEN', student_ring) == 0 then
+        redis.call('LREM', course_ring, 1, ARGV[2])
+    end
+end
+return removed
+'''
+
+# how long a claim lasts before the job that will honor it is created
+CLAIM_TTL = 60
+
+# An exponentially weighted moving average of the seconds between finished
+# Results, across all workers, for estimating when a submission will finish.
+# Gaps longer than THROUGHPUT_MAX_GAP are assumed to be idle time and ignored.
+THROUGHPUT_KEY = KEY_PREFIX + ':throughput'
+THROUGHPUT_WEIGHT = 0.1
+THROUGHPUT_MAX_GAP = 120
+
+THROUGHPUT_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local num_finished = tonumber(ARGV[2])
+local weight = tonumber(ARGV[3])
+local max_gap = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'last', 'interval')
+local last = tonumber(state[1])
+local interval = tonumber(state[2])
+if last ~= nil and now > last and now - last <= max_gap then
+    local sample = (now - last) / num_finished
+    if interval == nil then
+        interval = sample
+    else
+        -- as if each of the Results was averaged in separately
+        interval = interval + (1 - (1 - weight) ^ num_finished) * (sample - interval)
+    end
+    redis.call('HSET', KEYS[1], 'interval', tostring(interval))
+end
+redis.call('HSET', KEYS[1], 'last', tostring(now))
+'''
+
+
+def _ring_key(priority):
+    return '{}:{}'.format(KEY_PREFIX, priority)
+
+
+def _flow_key(priority, course_id, student_id):
+    return '{}:{}:{}'.format(_ring_key(priority), course_id, student_id)
+
+
+def _pending_key(kind, object_id):
+    return '{}:pending:{}:{}'.format(KEY_PREFIX, kind, object_id)
+
+
+def _generation_key(kind, object_id):
+    return '{}:generation:{}:{}'.format(KEY_PREFIX, kind, object_id)
+
+
+def get_connection():
+    return django_rq.get_queue(INTERACTIVE).connection
+
+
+def _is_pending(connection, job_id):
+    status = connection.hget(django_rq.get_queue(INTERACTIVE).job_class.key_for(job_id), 'status')
+    return status is not None and status.decode('utf-8') in (JobStatus.QUEUED, JobStatus.DEFERRED)
+
+
+def claim(kind, object_ids):
+    """Claim the right to enqueue a job for some objects.
+
+    An object can only be claimed if no job of the same kind is waiting for
+    it, so that repeated requests are absorbed by the job that is already
+    pending. The claim must be bound to the new job with bind(), and is
+    released when the job starts.
+
+    Parameters:
+        kind (str): the kind of job (eg. "evaluate")
+        object_ids ([int]): the IDs of the objects the jobs are for
+
+    Returns:
+        [int]: the IDs of the objects that were claimed
+    """
+    object_ids = list(object_ids)
+    if not object_ids:
+        return []
+    connection = get_connection()
+    keys = [_pending_key(kind, object_id) for object_id in object_ids]
+    with connection.pipeline() as pipeline:
+        for key in keys:
+            pipeline.set(key, '', nx=True, ex=CLAIM_TTL)
+        claimed = pipeline.execute()
+    for index, key in enumerate(keys):
+        if claimed[index]:
+            continue
+        job_id = connection.get(key)
+        if job_id is None or (job_id and not _is_pending(connection, job_id.decode('utf-8'))):
+            # the job is gone without releasing the claim (eg. the queue was
+            # cleared); an empty value means the job is still being created
+            connection.set(key, '', ex=CLAIM_TTL)
+            claimed[index] = True
+    return [object_id for object_id, success in zip(object_ids, claimed) if success]
+
+
+def bind(kind, object_ids, job_id, pipeline):
+    for object_id in object_ids:
+        pipeline.set(_pending_key(kind, object_id), job_id, ex=settings.SCHEDULER_JOB_TTL)
+
+
+def release(kind, object_ids):
+    keys = [_pending_key(kind, object_id) for object_id in object_ids]
+    if keys:
+        get_connection().delete(*keys)
+
+
+def get_pending_job_ids(kind, object_ids):
+    object_ids = list(object_ids)
+    if not object_ids:
+        return {}
+    job_ids = get_connection().mget([_pending_key(kind, object_id) for object_id in object_ids])
+    return {
+        object_id: job_id.decode('utf-8')
+        for object_id, job_id in zip(object_ids, job_ids)
+        if job_id
+    }
+
+
+def enqueue_once(queue_name, kind, object_id, func, *args):
+    """Enqueue a job unless the same kind of job for the object is waiting.
+
+    Parameters:
+        queue_name (str): the RQ queue to enqueue the job in
+        kind (str): the kind of job
+        object_id (int): the ID of the object the job is for
+        func (callable): the job function, which must call release()
+        *args: the arguments to the job function
+
+    Returns:
+        bool: whether a new job was enqueued
+    """
+    if not claim(kind, [object_id]):
+        return False
+    job = django_rq.get_queue(queue_name).enqueue(func, *args)
+    with get_connection().pipeline() as pipeline:
+        bind(kind, [object_id], job.id, pipeline)
+        pipeline.execute()
+    return True
+
+
+def advance_generation(kind, object_id):
+    """Supersede the jobs of some kind that are already running for an object.
+
+    Long-running jobs check is_superseded() with the generation they were
+    enqueued with, and stop once a newer job has been enqueued.
+
+    Parameters:
+        kind (str): the kind of job
+        object_id (int): the ID of the object the jobs are for
+
+    Returns:
+        int: the generation of the new job
+    """
+    key = _generation_key(kind, object_id)
+    with get_connection().pipeline() as pipeline:
+        pipeline.incr(key)
+        pipeline.expire(key, settings.SCHEDULER_JOB_TTL)
+        generation, _ = pipeline.execute()
+    return generation
+
+
+def is_superseded(kind, object_id, generation):
+    """Check whether a job has been superseded by a newer job for the same object.
+
+    A generation that has expired is not superseded; one that has expired and
+    restarted is, since it no longer matches.
+    """
+    current = get_connection().get(_generation_key(kind, object_id))
+    return current is not None and int(current) != generation
+
+
+def schedule(priority, course_id, student_id, jobs, result_ids):
+    """Add jobs to the fair-share queue of a priority class.
+
+    Jobs of the same class are moved into the RQ queue round-robin by course,
+    and then round-robin by student within each course, so that one student
+    (or one course's regrade) cannot push everyone else's jobs back.
+
+    Parameters:
+        priority (str): one of the priority classes
+        course_id (int): the course the jobs belong to
+        student_id (int): the student the jobs belong to
+        jobs ([(callable, tuple)]): the functions and arguments of each job
+        result_ids ([[int]]): for each job, the IDs of the Results it
+            evaluates, which must have been claimed
+    """
+    queue = django_rq.get_queue(priority)
+    connection = queue.connection
+    job_ids = []
+    with connection.pipeline() as pipeline:
+        for index, (func, args) in enumerate(jobs):
+            job = queue.job_class.create(
+                func,
+                args=args,
+                connection=connection,
+                origin=queue.name,
+                status=JobStatus.DEFERRED,
+                meta={'course': course_id, 'student': student_id, 'result_ids': result_ids[index]},
+            )
+            job.save(pipeline=pipeline)
+            job_ids.append(job.id)
+            bind('evaluate', result_ids[index], job.id, pipeline)
+        pipeline.execute()
+    if job_ids:
+        connection.register_script(PUSH_SCRIPT)(args=[_ring_key(priority), course_id, student_id, *job_ids])
+    pump(priority)
+    return job_ids
+
+
+def pump(priority=None):
+    """Move waiting jobs into the RQ queues, keeping each at most a window long.
+
+    This is called whenever jobs are scheduled and whenever an evaluation
+    finishes, so workers never wait for jobs while any are parked.
+
+    Parameters:
+        priority (str): the priority class to pump (default: all)
+    """
+    if priority is None:
+        for priority_class in PRIORITIES:
+            pump(priority_class)
+        return
+    queue = django_rq.get_queue(priority)
+    pop = queue.connection.register_script(POP_SCRIPT)
+    while queue.count < settings.SCHEDULER_WINDOW:
+        job_id = pop(args=[_ring_key(priority)])
+        if job_id is None:
+            break
+        try:
+            job = queue.job_class.fetch(job_id.decode('utf-8'), connection=queue.connection)
+        except NoSuchJobError:
+            continue
+        queue.enqueue_job(job)
+
+
+def count(priority=None):
+    """Count the jobs that have not started, both queued and parked."""
+    if priority is None:
+        return sum(count(priority_class) for priority_class in PRIORITIES)
+    queue = django_rq.get_queue(priority)
+    parked = queue.connection.get(_ring_key(priority) + ':size')
+    return queue.count + max(0, int(parked or 0))
+
+
+def get_position(job_id):
+    """Find how many jobs will start before a job.
+
+    Higher priority classes always go first. Within the job's own class, the
+    jobs already in the RQ queue go first, followed by the jobs that will be
+    picked round-robin from the other flows before this one.
+
+    Parameters:
+        job_id (str): the ID of the job
+
+    Returns:
+        int: the number of jobs ahead, or None if the job has already started
+    """
+    connection = get_connection()
+    try:
+        job = django_rq.get_queue(INTERACTIVE).job_class.fetch(job_id, connection=connection)
+    except NoSuchJobError:
+        return None
+    priority = job.origin
+    if priority not in PRIORITIES:
+        return None
+    ahead = sum(count(priority_class) for priority_class in PRIORITIES[:PRIORITIES.index(priority)])
+    queue = django_rq.get_queue(priority)
+    status = job.get_status()
+    if status == JobStatus.QUEUED:
+        job_ids = queue.job_ids
+        if job_id in job_ids:
+            return ahead + job_ids.index(job_id)
+        return None
+    if status != JobStatus.DEFERRED:
+        return None
+    flow = _flow_key(priority, job.meta['course'], job.meta['student'])
+    flow_ids = [value.decode('utf-8') for value in connection.lrange(flow, 0, -1)]
+    if job_id not in flow_ids:
+        return None
+    rank = flow_ids.index(job_id)
+    ahead += queue.count + rank
+    # every other flow in the class gets up to as many turns first
+    ring = _ring_key(priority)
+    courses = [value.decode('utf-8') for value in connection.lrange(ring, 0, -1)]
+    with connection.pipeline() as pipeline:
+        for course in courses:
+            pipeline.lrange('{}:{}'.format(ring, course), 0, -1)
+        student_rings = pipeline.execute()
+    other_flows = [
+        '{}:{}:{}'.format(ring, course, student.decode('utf-8'))
+        for course, students in zip(courses, student_rings)
+        for student in students
+    ]
+    other_flows = [other_flow for other_flow in other_flows if other_flow != flow]
+    with connection.pipeline() as pipeline:
+        for other_flow in other_flows:
+            pipeline.llen(other_flow)
+        lengths = pipeline.execute()
+    return ahead + sum(min(length, rank + 1) for length in lengths)
+
+
+def get_result_position(result_id):
+    job_id = get_pending_job_ids('evaluate', [result_id]).get(result_id)
+    if job_id is None:
+        return None
+    return get_position(job_id)
+
+
+def record_throughput(num_finished):
+    """Update the average time between finished Results.
+
+    Parameters:
+        num_finished (int): the number of Results that just finished
+    """
+    if num_finished <= 0:
+        return
+    connection = get_connection()
+    connection.register_script(THROUGHPUT_SCRIPT)(
+        keys=[THROUGHPUT_KEY],
+        args=[time(), num_finished, THROUGHPUT_WEIGHT, THROUGHPUT_MAX_GAP],
+    )
+
+
+def get_throughput_interval():
+    """Get the average number of seconds between finished Results.
+
+    Returns:
+        float: the number of seconds, or None if it is not yet known
+    """
+    interval = get_connection().hget(THROUGHPUT_KEY, 'interval')
+    if interval is None:
+        return None
+    return float(interval)
+
+
+def cancel_evaluations(result_ids):
+    """Cancel the waiting evaluations of Results that are being superseded.
+
+    A job is only cancelled if all the Results it evaluates are given; other
+    jobs are left to skip the Results that no longer exist.
+
+    Parameters:
+        result_ids ([int]): the IDs of the superseded Results
+    """
+    result_ids = set(result_ids)
+    connection = get_connection()
+    job_class = django_rq.get_queue(INTERACTIVE).job_class
+    for job_id in set(get_pending_job_ids('evaluate', result_ids).values()):
+        try:
+            job = job_class.fetch(job_id, connection=connection)
+        except NoSuchJobError:
+            continue
+        if job.origin not in PRIORITIES or not set(job.meta.get('result_ids', [])) <= result_ids:
+            continue
+        status = job.get_status()
+        if status == JobStatus.DEFERRED:
+            cancel = connection.register_script(CANCEL_SCRIPT)
+            cancel(args=[_ring_key(job.origin), job.meta['course'], job.meta['student'], job_id])
+        elif status == JobStatus.QUEUED:
+            django_rq.get_queue(job.origin).remove(job)
+        else:
+            continue
+        job.delete()
+    release('evaluate', result_ids)
+
+
+def clear(priority=None):
+    """Remove all jobs that have not started from a priority class."""
+    if priority is None:
+        for priority_class in PRIORITIES:
+            clear(priority_class)
+        return
+    queue = django_rq.get_queue(priority)
+    connection = queue.connection
+    ring = _ring_key(priority)
+    keys = [ring, ring + ':size']
+    for course in connection.lrange(ring, 0, -1):
+        student_ring = '{}:{}'.format(ring, course.decode('utf-8'))
+        keys.append(student_ring)
+        for student in connection.lrange(student_ring, 0, -1):
+            flow = '{}:{}'.format(student_ring, student.decode('utf-8'))
+            keys.append(flow)
+            for job_id in connection.lrange(flow, 0, -1):
+                keys.append(queue.job_class.key_for(job_id.decode('utf-8')))
+    connection.delete(*keys)
+    queue.empty()
+    # the claims of the removed jobs are taken over when they are next
+    # enqueued, since their jobs no longer exist
+
+
+def group_by_flow(rows):
+    """Group (result ID, submission ID, student ID, course ID) rows.
+
+    Returns:
+        dict: from (course ID, student ID) to a dict from submission ID to a
+            list of result IDs
+    """
+    flows = defaultdict(lambda: defaultdict(list))
+    for result_id, submission_id, student_id, course_id in rows:
+        flows[(course_id, student_id)][submission_id].append(result_id)
+    return flows
@@ -98,13 +98,49 @@ SOCIAL_AUTH_GOOGLE_OAUTH2_AUTH_EXTRA_ARGUMENTS = {'prompt': 'select_account'}
 # Database
 # https://docs.djangoproject.com/en/1.9/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+# the database is chosen by the DEMOGRADER_DATABASE environment variable;
+# PostgreSQL credentials are read from the "postgresql" object in secrets.json
+
+SQLITE_DATABASE = {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+    'OPTIONS': {
+        # seconds to wait for a lock before giving up
+        'timeout': 20,
+    },
 }
 
+if os.environ.get('DEMOGRADER_DATABASE', 'sqlite') == 'postgresql':
+    with open(os.path.join(BASE_DIR, 'demograder', 'secrets.json')) as fd:
+        postgresql_dict = read_json(fd).get('postgresql', {})
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': postgresql_dict.get('name', 'demograder'),
+            'USER': postgresql_dict.get('user', 'demograder'),
+            'PASSWORD': postgresql_dict.get('password', ''),
+            'HOST': postgresql_dict.get('host', 'localhost'),
+            'PORT': postgresql_dict.get('port', '5432'),
+            # keep connections open between requests and jobs
+            'CONN_MAX_AGE': 600,
+        },
+        # the old database, to copy from with `./manage.py copy_database`
+        'sqlite': SQLITE_DATABASE,
+    }
+else:
+    DATABASES = {
+        'default': SQLITE_DATABASE,
+    }
+
+# attempts to save evaluation results if the database is locked, with
+# exponential backoff starting at the delay (in seconds) between them
+DATABASE_WRITE_ATTEMPTS = 5
+DATABASE_WRITE_DELAY = 0.5
+
+# whether workers send evaluation results to a single writer (the result_sink
+# management command) instead of writing them to the database themselves
+RESULT_SINK = False
+
 # RQ queues
 # https://github.com/ui/django-rq
 
@@ -121,8 +157,68 @@ RQ_QUEUES = {
         'DB': 0,
         'DEFAULT_TIMEOUT': 360,
     },
+    'regrade': {
+        'HOST': 'localhost',
+        'PORT': 6379,
+        'DB': 0,
+        'DEFAULT_TIMEOUT': 360,
+    },
+    'recovery': {
+        'HOST': 'localhost',
+        'PORT': 6379,
+        'DB': 0,
+        'DEFAULT_TIMEOUT': 360,
+    },
 }
 
+# Evaluation
+# number of Results of a submission evaluated by one job in one sandbox; 1
+# enqueues a separate job for each Result
+
+EVALUATION_BATCH_SIZE = 1
+
+# only the beginning and end of the output of each test is kept, in bytes; a
+# test that prints more than the maximum in total is stopped
+
+OUTPUT_HEAD_SIZE = 2**15
+OUTPUT_TAIL_SIZE = 2**15
+OUTPUT_MAX_SIZE = 2**24
+
+# a cgroup (v2) directory delegated to the evaluation workers' user, under
+# which each test of a project with resource limits gets its own cgroup (eg.
+# "/sys/fs/cgroup/demograder"); None ignores the limits
+
+CGROUP_ROOT = None
+
+# path of the socket of a running zygote (see demograder/zygote.py), which
+# forks Python grading scripts from a warm interpreter; None runs every
+# script in a new process
+
+ZYGOTE_SOCKET = None
+
+# Scheduling
+# evaluation jobs wait in per-student flows and are moved into the RQ queue of
+# their priority class round-robin; the window is the most jobs each RQ queue
+# holds at once, so it should be a little more than the number of workers
+
+SCHEDULER_WINDOW = 8
+SCHEDULER_JOB_TTL = 24 * 60 * 60
+
+# Live updates
+# pages with unfinished results listen for them over Server-Sent Events; each
+# stream occupies a web server thread, so streams are closed (and reopened by
+# the browser) after a while
+
+EVENT_STREAM_LIFETIME = 120
+EVENT_STREAM_HEARTBEAT = 15
+
+# File serving
+# if set to the internal nginx location that serves the uploads directory (eg.
+# '/protected/uploads/', as in nginx.conf), uploads are sent by nginx with
+# X-Accel-Redirect after Django checks permissions; otherwise Django sends them
+
+UPLOAD_ACCEL_REDIRECT = None
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
@@ -0,0 +1,76 @@
+from time import time
+
+from .scheduler import get_connection
+
+KEY_PREFIX = 'demograder:throttle'
+
+# A token bucket per student and project: it holds up to `burst` tokens, one
+# token is added every `interval` seconds, and each submission takes a token.
+# Returns the number of seconds until a token is available (0 if one is, in
+# which case it is taken if ARGV[4] is 1).
+BUCKET_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local take = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1])
+local updated = tonumber(state[2])
+if tokens == nil or updated == nil then
+    tokens = burst
+    updated = now
+end
+tokens = math.min(burst, tokens + math.max(0, now - updated) / interval)
+if tokens < 1 then
+    return tostring((1 - tokens) * interval)
+end
+if take == 1 then
+    redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens - 1), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(interval * burst))
+end
+return '0'
+'''
+
+
+def _bucket_key(student_id, project_id):
+    return '{}:{}:{}'.format(KEY_PREFIX, student_id, project_id)
+
+
+def _run_bucket(student_id, project, take):
+    if project.submission_interval <= 0:
+        return 0
+    connection = get_connection()
+    wait = connection.register_script(BUCKET_SCRIPT)(
+        keys=[_bucket_key(student_id, project.id)],
+        args=[time(), project.submission_interval, max(1, project.submission_burst), int(take)],
+    )
+    return float(wait)
+
+
+def get_submission_wait(student_id, project):
+    """Get the number of seconds until a student may submit to a project again.
+
+    Parameters:
+        student_id (int): the ID of the student (Person)
+        project (Project): the project to submit to
+
+    Returns:
+        float: the number of seconds, or 0 if the student may submit now
+    """
+    return _run_bucket(student_id, project, take=False)
+
+
+def take_submission_token(student_id, project):
+    """Atomically check and use up a student's allowance to submit.
+
+    Of two concurrent submissions with only one token left, only one succeeds.
+
+    Parameters:
+        student_id (int): the ID of the student (Person)
+        project (Project): the project to submit to
+
+    Returns:
+        float: 0 if the student may submit (and a token was used up),
+            otherwise the number of seconds until they may
+    """
+    return _run_bucket(student_id, project, take=True)
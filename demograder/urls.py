@@ -4,8 +4,9 @@ from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from django.views.generic import RedirectView
 from django.contrib.auth.views import LoginView, LogoutView
 
-from .views import index_view, course_view, project_view, project_submit_handler, result_view, download_view, display_view
+from .views import index_view, course_view, project_view, project_submit_handler, submission_events_view, submission_status_view, result_view, download_view, display_view
 from .instructor_views import instructor_view, instructor_tbd_view, instructor_submissions_view, instructor_student_view, instructor_course_view, instructor_assignment_view, instructor_project_view
+from .instructor_views import instructor_grades_export_view, instructor_results_export_view, instructor_uploads_export_view
 from .instructor_views import instructor_clear_queue_view, instructor_tbd_regrade_view, instructor_assignment_regrade_view, instructor_project_regrade_view, instructor_submission_regrade_view, instructor_result_regrade_view
 
 urlpatterns = [
@@ -18,6 +19,8 @@ urlpatterns = [
     url(r'^demograder/project/(?P<project_id>[0-9]+)/$', project_view, name='project'),
     url(r'^demograder/project/(?P<project_id>[0-9]+)/submit/$', project_submit_handler, name='project_submit'),
     url(r'^demograder/submission/(?P<submission_id>[0-9]+)/$', project_view, name='submission'),
+    url(r'^demograder/submission/(?P<submission_id>[0-9]+)/events/$', submission_events_view, name='submission_events'),
+    url(r'^demograder/submission/(?P<submission_id>[0-9]+)/status/$', submission_status_view, name='submission_status'),
     url(r'^demograder/result/(?P<result_id>[0-9]+)/$', result_view, name='result'),
     url(r'^demograder/download/(?P<upload_id>[0-9]+)/$', download_view, name='download'),
     url(r'^demograder/display/(?P<upload_id>[0-9]+)/$', display_view, name='display'),
@@ -54,6 +57,46 @@ urlpatterns = [
         instructor_result_regrade_view,
         name='instructor_result_regrade',
     ),
+    url(
+        r'^demograder/instructor/course/(?P<course_id>[0-9]+)/grades\.(?P<export_format>csv|json)$',
+        instructor_grades_export_view,
+        name='instructor_grades_export',
+    ),
+    url(
+        r'^demograder/instructor/assignment/(?P<assignment_id>[0-9]+)/grades\.(?P<export_format>csv|json)$',
+        instructor_grades_export_view,
+        name='instructor_grades_export',
+    ),
+    url(
+        r'^demograder/instructor/project/(?P<project_id>[0-9]+)/grades\.(?P<export_format>csv|json)$',
+        instructor_grades_export_view,
+        name='instructor_grades_export',
+    ),
+    url(
+        r'^demograder/instructor/course/(?P<course_id>[0-9]+)/results\.(?P<export_format>csv|json)$',
+        instructor_results_export_view,
+        name='instructor_results_export',
+    ),
+    url(
+        r'^demograder/instructor/assignment/(?P<assignment_id>[0-9]+)/results\.(?P<export_format>csv|json)$',
+        instructor_results_export_view,
+        name='instructor_results_export',
+    ),
+    url(
+        r'^demograder/instructor/project/(?P<project_id>[0-9]+)/results\.(?P<export_format>csv|json)$',
+        instructor_results_export_view,
+        name='instructor_results_export',
+    ),
+    url(
+        r'^demograder/instructor/assignment/(?P<assignment_id>[0-9]+)/uploads\.zip$',
+        instructor_uploads_export_view,
+        name='instructor_uploads_export',
+    ),
+    url(
+        r'^demograder/instructor/project/(?P<project_id>[0-9]+)/uploads\.zip$',
+        instructor_uploads_export_view,
+        name='instructor_uploads_export',
+    ),
     url(r'^django-rq/', include('django_rq.urls')),
     url(r'^admin/', admin.site.urls),
     url(r'^accounts/login/$', LoginView.as_view(), name='admin_login'),
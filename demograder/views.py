@@ -1,15 +1,27 @@
-from collections import namedtuple
+import json
+from hashlib import sha1
+from math import ceil
+from mimetypes import guess_type
+from os import pardir
+from os.path import abspath, relpath
+from urllib.parse import quote
 
-import django_rq
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
 from django.urls import reverse
-from django.http import HttpResponseRedirect, FileResponse
+from django.utils.http import parse_etags, quote_etag
+from django.http import Http404, HttpResponse, HttpResponseNotModified, HttpResponseRedirect, FileResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 
+from .events import stream_submission_events
 from .forms import SubmissionUploadForm
-from .models import Course, Enrollment, Person, Assignment, Project, Submission, Upload, Result, ProjectDependency
-from .dispatcher import enqueue_submission_dispatch
+from .models import UPLOAD_PATH, Course, Enrollment, Person, Assignment, Project, Submission, Upload, Result, ProjectDependency
+from .dispatcher import enqueue_submission_dispatch, enqueue_downstream_dispatch
+from .filestore import store_upload
+from .pagination import paginate_submissions
+from .gradebook import get_latest_submissions, get_submission_displays, get_grade
+from .scheduler import INTERACTIVE, count as count_queued, get_result_position, get_throughput_interval
 
 
 def get_context(request, **kwargs):
@@ -82,44 +94,24 @@ def index_view(request, **kwargs):
     return render(request, 'demograder/index.html', context)
 
 
-SubmissionDisplay = namedtuple(
-    'SubmissionDisplay',
-    [
-        'student',
-        'project',
-        'iso_format',
-        'num_passed',
-        'num_tbd',
-        'num_failed',
-        'max_score',
-        'score_str',
-    ],
-)
-
-
-def get_last_submission_display(submitter, project):
-    submission = submitter.latest_submission(project)
-    if submission:
-        return submission
-    else:
-        return SubmissionDisplay(submitter, project, '', 0, 0, 0, 0, '')
-
-
 @login_required
 def course_view(request, **kwargs):
     context = get_context(request, **kwargs)
+    projects = list(Project.objects.filter(assignment__course=context['course']).select_related('assignment'))
+    latest_submissions = get_latest_submissions([context['person']], projects)
     assignments = []
     for assignment in context['course'].assignments():
-        if assignment.has_visible_projects or context['is_instructor']:
-            submissions = []
-            for project in assignment.projects():
-                if project.visible or context['is_instructor']:
-                    submissions.append(get_last_submission_display(context['person'], project))
-            assignments.append([
-                assignment,
-                '{:.2%}'.format(context['person'].get_assignment_score(assignment)),
-                submissions,
-            ])
+        # assignments are listed even if none of their projects are visible
+        assignment_projects = [project for project in projects if project.assignment_id == assignment.id]
+        shown_projects = [
+            project for project in assignment_projects
+            if project.visible or context['is_instructor']
+        ]
+        assignments.append([
+            assignment,
+            '{:.2%}'.format(get_grade(context['person'], assignment_projects, latest_submissions)),
+            get_submission_displays(context['person'], shown_projects, latest_submissions),
+        ])
     context['assignments'] = assignments
     return render(request, 'demograder/course.html', context)
 
@@ -128,23 +120,24 @@ def course_view(request, **kwargs):
 def project_view(request, **kwargs):
     context = get_context(request, **kwargs)
     submissions = context['student'].submissions(project=context['project'])
-    if bool(submissions):
-        context['submissions'] = submissions.order_by('-timestamp')
+    project_latest = submissions.order_by('-timestamp', '-id').first()
+    if project_latest is not None:
+        context['project_latest'] = project_latest
         if 'submission' not in context:
-            context['submission'] = context['submissions'][0]
-        # FIXME select the latest submission using the django last filter instead
-        # see https://docs.djangoproject.com/en/1.11/ref/templates/builtins/#last
-        context['project_latest'] = context['submissions'][0]
+            context['submission'] = project_latest
+        context['num_submissions'] = submissions.count()
+        context['submissions_page'] = paginate_submissions(request, submissions.prefetch_related('upload_set'))
+        context['submissions'] = context['submissions_page'].items
         context['results'] = context['submission'].result_set.all()
-    context['may_submit'] = context['person'].may_submit(context['project'])
-    # FIXME select the latest submission using the django last filter instead
-    # see https://docs.djangoproject.com/en/1.11/ref/templates/builtins/#last
-    if context['person'].submissions():
-        context['latest'] = context['person'].latest_submission()
-    else:
-        context['latest'] = None
+        if context['submission'].num_tbd:
+            tbd_result = context['results'].filter(return_code=None).order_by('id').first()
+            if tbd_result:
+                context['queue_position'] = get_result_position(tbd_result.id)
+    context['may_submit'], submission_wait = context['person'].get_submission_status(context['project'])
+    context['submission_wait'] = ceil(submission_wait / 60)
+    context['latest'] = context['person'].latest_submission()
     context['form'] = SubmissionUploadForm(project=context['project'])
-    context['queue_size'] = django_rq.get_queue('evaluation').count
+    context['queue_size'] = count_queued(INTERACTIVE)
     return render(request, 'demograder/project.html', context)
 
 
@@ -153,10 +146,11 @@ def project_submit_handler(request, **kwargs):
     context = get_context(request, **kwargs)
     if request.method != 'POST':
         return HttpResponseRedirect(reverse('project', kwargs=kwargs))
-    if context['person'].may_submit(context['project']) != 'yes':
-        return HttpResponseRedirect(reverse('project', kwargs=kwargs))
     form = SubmissionUploadForm(request.POST, request.FILES, project=context['project'])
-    if form.is_valid() and bool(request.FILES):
+    if not (form.is_valid() and bool(request.FILES)):
+        return HttpResponseRedirect(reverse('project', kwargs=kwargs))
+    # only use up a submission once the upload is known to be valid
+    if context['person'].may_submit(context['project'], take=True) == 'yes':
         submission = Submission(
             project=context['project'],
             student=context['person'],
@@ -164,34 +158,128 @@ def project_submit_handler(request, **kwargs):
         submission.save()
         for file_field, project_file in zip(context['project'].file_fields, context['project'].files):
             if file_field in request.FILES:
-                Upload(
+                upload = Upload(
                     submission=submission,
                     project_file=project_file,
                     file=request.FILES[file_field],
-                ).save()
+                )
+                upload.save()
+                store_upload(upload)
         enqueue_submission_dispatch(submission.id)
+        enqueue_downstream_dispatch(submission.id)
     return HttpResponseRedirect(reverse('project', kwargs=kwargs))
 
 
+@login_required
+def submission_events_view(request, **kwargs):
+    context = get_context(request, **kwargs)
+    response = StreamingHttpResponse(
+        stream_submission_events(context['submission'].id, settings.EVENT_STREAM_LIFETIME, settings.EVENT_STREAM_HEARTBEAT),
+        content_type='text/event-stream',
+    )
+    response['Cache-Control'] = 'no-cache'
+    # stop nginx from buffering the events
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@login_required
+def submission_status_view(request, **kwargs):
+    # unlike the other views, this does not use get_context, so that polling
+    # only costs a single query while the submission is not being evaluated
+    status = Submission.objects.filter(id=kwargs['submission_id']).values(
+        'student__user_id', 'project__assignment__course__instructor__user_id',
+        'num_passed', 'num_failed', 'num_tbd',
+    ).first()
+    if status is None:
+        raise Http404
+    allowed_user_ids = (status['student__user_id'], status['project__assignment__course__instructor__user_id'])
+    if not request.user.is_superuser and request.user.id not in allowed_user_ids:
+        raise PermissionDenied
+    data = {
+        'passed': status['num_passed'],
+        'failed': status['num_failed'],
+        'tbd': status['num_tbd'],
+        'queue_position': None,
+        'estimated_seconds': None,
+    }
+    if status['num_tbd']:
+        tbd_result_id = Result.objects.filter(
+            submission_id=kwargs['submission_id'],
+            return_code=None,
+        ).order_by('id').values_list('id', flat=True).first()
+        if tbd_result_id is not None:
+            data['queue_position'] = get_result_position(tbd_result_id)
+        interval = get_throughput_interval()
+        if interval is not None:
+            data['estimated_seconds'] = round(((data['queue_position'] or 0) + status['num_tbd']) * interval)
+    etag = quote_etag(sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest())
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse(data)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @login_required
 def result_view(request, **kwargs):
     context = get_context(request, **kwargs)
     return render(request, 'demograder/result.html', context)
 
 
+def get_accel_redirect_path(upload):
+    """Get the nginx internal location of an upload, if nginx serves uploads.
+
+    Parameters:
+        upload (Upload): the upload to serve
+
+    Returns:
+        str: the URL for X-Accel-Redirect, or None if Django should serve it
+    """
+    if not settings.UPLOAD_ACCEL_REDIRECT:
+        return None
+    path = relpath(abspath(upload.file.name), abspath(UPLOAD_PATH))
+    if path.startswith(pardir):
+        return None
+    return settings.UPLOAD_ACCEL_REDIRECT + quote(path)
+
+
 @login_required
 def download_view(request, **kwargs):
     context = get_context(request, **kwargs)
-    return FileResponse(
-        open(context['upload'].file.name, 'rb'),
-        as_attachment=True,
-    )
+    upload = context['upload']
+    accel_path = get_accel_redirect_path(upload)
+    if accel_path is None:
+        response = FileResponse(
+            open(upload.file.name, 'rb'),
+            as_attachment=True,
+        )
+    else:
+        # only check permissions; nginx sends the file
+        # display_view loads the file with ?inline=1, which is always shown as
+        # plain text so that uploaded HTML or SVG is never rendered
+        if request.GET.get('inline') == '1':
+            content_type = 'text/plain; charset=utf-8'
+            disposition = 'inline'
+        else:
+            content_type = guess_type(upload.basename)[0] or 'application/octet-stream'
+            disposition = 'attachment'
+        response = HttpResponse(content_type=content_type)
+        response['Content-Disposition'] = "{}; filename*=UTF-8''{}".format(disposition, quote(upload.basename))
+        response['X-Accel-Redirect'] = accel_path
+    response['X-Content-Type-Options'] = 'nosniff'
+    return response
 
 
 @login_required
 def display_view(request, **kwargs):
     context = get_context(request, **kwargs)
-    file_full_path = context['upload'].file.name
-    with open(file_full_path) as fd:
-        context['contents'] = fd.read()
+    if get_accel_redirect_path(context['upload']) is None:
+        with open(context['upload'].file.name) as fd:
+            context['contents'] = fd.read()
+    else:
+        # the page loads the file from nginx instead
+        context['contents_url'] = reverse('download', kwargs={'upload_id': context['upload'].id}) + '?inline=1'
     return render(request, 'demograder/display.html', context)
@@ -0,0 +1,22 @@
+from django.db import close_old_connections
+from rq.worker import SimpleWorker
+
+
+class PersistentConnectionWorker(SimpleWorker):
+    """An RQ worker that reuses its database connection between jobs.
+
+    The default RQ worker forks a new process for every job, so every job
+    opens (and tears down) its own database connection. This worker runs jobs
+    in its own process instead, and treats each job like Django treats a
+    request: connections that have outlived CONN_MAX_AGE or are broken are
+    closed before and after the job, and the rest are reused.
+
+    Use it with `rqworker --worker-class demograder.worker.PersistentConnectionWorker`.
+    """
+
+    def perform_job(self, *args, **kwargs):
+        close_old_connections()
+        try:
+            return super().perform_job(*args, **kwargs)
+        finally:
+            close_old_connections()
@@ -0,0 +1,277 @@
+"""A warm Python interpreter for running grading scripts.
+
+Starting a Python interpreter and importing dglib takes much longer than most
+function tests. The zygote imports them once and then forks a child for each
+test, which runs the grading script in the sandbox as if it had been executed
+directly. The zygote must be started as the same user that the sandboxed
+scripts would otherwise run as:
+
+    sudo -u nobody python3 -m demograder.zygote /path/to/zygote.sock
+
+This module does not depend on Django, so that it can be run by itself and
+imported by the dispatcher.
+"""
+
+import json
+import sys
+from base64 import b64decode, b64encode
+from os import chdir, chmod, close, devnull, dup2, fork, killpg, open as os_open, O_RDONLY
+from os import pipe, sched_setaffinity, setpgid, unlink, _exit
+from os.path import dirname, exists, realpath
+from signal import signal, SIGCHLD, SIGKILL, SIG_DFL, SIG_IGN
+from socket import socket, AF_UNIX, SOCK_STREAM
+from time import monotonic, sleep
+from traceback import print_exc
+
+from demograder.process import CHUNK_SIZE, OUTPUT_LIMIT_RETURN_CODE, Usage
+from demograder.process import collect_output, parse_cpus, poll_process, wait_process
+
+# modules imported before forking, so that the tests do not have to
+PRELOAD_MODULES = [
+    'ast',
+    'collections',
+    'contextlib',
+    'importlib.util',
+    'io',
+    'itertools',
+    'math',
+    'random',
+    're',
+    'runpy',
+    'subprocess',
+    'textwrap',
+]
+
+# the number of seconds between checks on whether a test has finished
+REAP_INTERVAL = 0.01
+
+
+def preload():
+    for module in PRELOAD_MODULES:
+        __import__(module)
+    # dglib is copied into every sandbox, but it is the same file
+    sys.path.insert(0, dirname(realpath(__file__)))
+    __import__('dglib')
+    del sys.path[0]
+
+
+def run_script(request, stdout_fd, stderr_fd):
+    """Run a grading script in the current (forked) process.
+
+    This never returns; the process exits with the exit code of the script.
+    """
+    from runpy import run_path
+    stdin_fd = os_open(devnull, O_RDONLY)
+    dup2(stdin_fd, 0)
+    dup2(stdout_fd, 1)
+    dup2(stderr_fd, 2)
+    for fd in (stdin_fd, stdout_fd, stderr_fd):
+        close(fd)
+    exit_code = 0
+    try:
+        chdir(request['cwd'])
+        if request.get('cpus'):
+            sched_setaffinity(0, parse_cpus(request['cpus']))
+        sys.argv = [request['script']]
+        sys.path[0] = request['cwd']
+        run_path(request['script'], run_name='__main__')
+    except SystemExit as exit_exception:
+        if exit_exception.code is None:
+            exit_code = 0
+        elif isinstance(exit_exception.code, int):
+            exit_code = exit_exception.code
+        else:
+            print(exit_exception.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException: # pylint: disable=broad-except
+        print_exc()
+        exit_code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    _exit(exit_code & 0xff)
+
+
+def reap(pid, start_time, deadline):
+    """Wait for a test, killing it (with any processes it started) at the deadline.
+
+    Parameters:
+        pid (int): the process ID (and process group ID) of the test
+        start_time (float): the value of time.monotonic() when it started
+        deadline (float): the value of time.monotonic() to kill it at
+
+    Returns:
+        int: the return code, -9 if it was killed
+        Usage: the resources used by the test
+    """
+    while monotonic() < deadline:
+        status = poll_process(pid, start_time)
+        if status is not None:
+            return status
+        sleep(REAP_INTERVAL)
+    try:
+        killpg(pid, SIGKILL)
+    except ProcessLookupError:
+        pass
+    return wait_process(pid, start_time)
+
+
+def run_test(request, connection):
+    stdout_read, stdout_write = pipe()
+    stderr_read, stderr_write = pipe()
+    start_time = monotonic()
+    pid = fork()
+    if pid == 0:
+        # the script runs in this process, so it must not be able to write
+        # a response to the worker itself
+        connection.close()
+        close(stdout_read)
+        close(stderr_read)
+        setpgid(0, 0)
+        run_script(request, stdout_write, stderr_write)
+    close(stdout_write)
+    close(stderr_write)
+    try:
+        setpgid(pid, pid)
+    except OSError:
+        # the child has already done so (or exited)
+        pass
+    output, timed_out, exceeded = collect_output(
+        [stdout_read, stderr_read],
+        timeout=request['timeout'],
+        head_size=request.get('head_size'),
+        tail_size=request.get('tail_size', 0),
+        max_size=request.get('max_size'),
+    )
+    if timed_out or exceeded:
+        # like `timeout -s KILL`, but also kills any processes it started
+        try:
+            killpg(pid, SIGKILL)
+        except ProcessLookupError:
+            pass
+    close(stdout_read)
+    close(stderr_read)
+    # the script may also close its output and keep running; if it finished
+    # but left processes holding the output open, it has not timed out
+    return_code, usage = reap(pid, start_time, start_time + request['timeout'])
+    if exceeded:
+        return_code = OUTPUT_LIMIT_RETURN_CODE
+    return {
+        'stdout': b64encode(output[stdout_read].getvalue()).decode('ascii'),
+        'stderr': b64encode(output[stderr_read].getvalue()).decode('ascii'),
+        'stdout_size': output[stdout_read].size,
+        'stderr_size': output[stderr_read].size,
+        'return_code': return_code,
+        'exceeded': exceeded,
+        'usage': usage,
+    }
+
+
+def receive_line(connection):
+    data = bytearray()
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(CHUNK_SIZE)
+        if not chunk:
+            break
+        data.extend(chunk)
+    return bytes(data)
+
+
+def handle(connection):
+    request = json.loads(receive_line(connection).decode('utf-8'))
+    response = run_test(request, connection)
+    connection.sendall(json.dumps(response).encode('utf-8') + b'\n')
+
+
+def serve(socket_path):
+    preload()
+    if exists(socket_path):
+        unlink(socket_path)
+    server = socket(AF_UNIX, SOCK_STREAM)
+    server.bind(socket_path)
+    # access is controlled by the permissions of the enclosing directory
+    chmod(socket_path, 0o777)
+    server.listen(64)
+    # the runners are never waited for
+    signal(SIGCHLD, SIG_IGN)
+    while True:
+        connection, _ = server.accept()
+        pid = fork()
+        if pid == 0:
+            server.close()
+            signal(SIGCHLD, SIG_DFL)
+            try:
+                handle(connection)
+            except Exception: # pylint: disable=broad-except
+                print_exc()
+            finally:
+                _exit(0)
+        connection.close()
+
+
+def request_evaluation(socket_path, cwd, script, timeout, cpus=None, head_size=None, tail_size=0, max_size=None):
+    """Run a grading script through a zygote.
+
+    Parameters:
+        socket_path (str): the path of the zygote's socket
+        cwd (str): the sandbox directory to run the script in
+        script (str): the path of the grading script
+        timeout (int): the number of seconds before the script is killed
+        cpus (str): if given, the CPUs to pin the script to
+        head_size (int): the number of bytes to keep from the beginning of
+            each output stream, or None to keep everything
+        tail_size (int): the number of bytes to keep from the end of each
+            output stream
+        max_size (int): if given, the number of bytes of output to kill the
+            script after
+
+    Returns:
+        bytes: the (bounded) standard output of the script
+        bytes: the (bounded) standard error of the script
+        (int, int): the sizes of the standard output and error in bytes
+        int: the return code of the script, -9 if it timed out, or
+            OUTPUT_LIMIT_RETURN_CODE if it printed more than max_size bytes
+        Usage: the resources used by the script
+        bool: whether the script was killed for printing more than max_size
+            bytes, which its return code alone cannot tell from SIGPIPE
+
+    Raises:
+        OSError: if the zygote cannot be reached
+    """
+    with socket(AF_UNIX, SOCK_STREAM) as client:
+        # allow for the zygote being slow to fork under load
+        client.settimeout(timeout + 60)
+        client.connect(socket_path)
+        request = {
+            'cwd': cwd,
+            'script': script,
+            'timeout': timeout,
+            'cpus': cpus,
+            'head_size': head_size,
+            'tail_size': tail_size,
+            'max_size': max_size,
+        }
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        response = receive_line(client)
+    if not response:
+        raise ConnectionError('zygote closed the connection without a response')
+    response = json.loads(response.decode('utf-8'))
+    return (
+        b64decode(response['stdout']),
+        b64decode(response['stderr']),
+        (response['stdout_size'], response['stderr_size']),
+        response['return_code'],
+        Usage(*response['usage']),
+        response['exceeded'],
+    )
+
+
+def main():
+    if len(sys.argv) != 2:
+        print('usage: {} SOCKET'.format(sys.argv[0]), file=sys.stderr)
+        sys.exit(1)
+    serve(sys.argv[1])
+
+
+if __name__ == '__main__':
+    main()